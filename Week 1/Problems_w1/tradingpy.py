@@ -7,7 +7,6 @@ Created on Sat May 7 00:16:07 2020
 import time
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
 from ultilities import barstr, timestr
 
 ###TRADING RULES
@@ -263,22 +262,42 @@ class Backtester:
             return self.balancePath
         t_start = self.balancePath['_t'].iloc[-1]
         _trades = self.tradeData[self.tradeData['_t']>=t_start] 
-        for i in tqdm(range(1, _trades.shape[0]), disable=True):
-            last_trade = _trades.iloc[i-1]
-            new_trade =  _trades.iloc[i]
-            tradeTime, change = new_trade['_t'], 0
-            for sig in self.signalList:
-                if last_trade['_t'] <= sig.excTime and sig.excTime < tradeTime:
-                    change -= self.commRate[sig.orderType]*sig.get_quantity()*sig.excPrice
-                    change += SIDE[sig.side]*sig.get_quantity()*(new_trade['_p'] - sig.excPrice)
-                if last_trade['_t'] <= sig.clsTime and sig.clsTime < tradeTime:
-                    change -= self.commRate[sig.cntType]*sig.get_quantity()*sig.clsPrice
-                    change += SIDE[sig.side]*sig.get_quantity()*(sig.clsPrice - last_trade['_p'])
-                if sig.excTime < last_trade['_t'] and tradeTime <= sig.clsTime:
-                    change += SIDE[sig.side]*sig.get_quantity()*(new_trade['_p'] - last_trade['_p'])
-            last_update = self.balancePath.iloc[-1]
-            self.balancePath = self.balancePath.append({'_t': int(tradeTime), '_b': float(last_update['_b']+change)}, ignore_index=True)
+        if _trades.shape[0] < 2:
+            return self.balancePath
+        _t, _p = _trades['_t'].values, _trades['_p'].values.astype(float)
+        _b = float(self.balancePath['_b'].iloc[-1]) + np.cumsum(self.balance_changes(_t, _p))
+        self.balancePath = pd.concat([self.balancePath, pd.DataFrame({'_t': _t[1:].astype(int), '_b': _b})], ignore_index=True)
         return self.balancePath
+
+    def balance_changes(self, _t, _p):
+        '''
+        Returns the balance change over every trade interval [_t[i-1], _t[i]) from the entry and exit events of the signals
+        '''
+        n = _t.shape[0]
+        qty = np.array([SIDE[sig.side]*sig.get_quantity() for sig in self.signalList], dtype=float)
+        exc = np.array([sig.excTime for sig in self.signalList], dtype=float)
+        cls = np.array([sig.clsTime for sig in self.signalList], dtype=float)
+        excPrice = np.array([sig.excPrice for sig in self.signalList], dtype=float)
+        clsPrice = np.array([sig.clsPrice for sig in self.signalList], dtype=float)
+        excComm = np.array([self.commRate[sig.orderType] for sig in self.signalList])*np.abs(qty)*excPrice
+        clsComm = np.array([self.commRate[sig.cntType] for sig in self.signalList])*np.abs(qty)*clsPrice
+        change = np.zeros(n)
+        # entry in the interval ending at trade i: _t[i-1] <= excTime < _t[i]
+        i_exc = np.searchsorted(_t, exc, side='right')
+        _in = (i_exc >= 1) & (i_exc < n)
+        np.add.at(change, i_exc[_in], -excComm[_in] + qty[_in]*(_p[i_exc[_in]] - excPrice[_in]))
+        # exit in the interval ending at trade i: _t[i-1] <= clsTime < _t[i]
+        i_cls = np.searchsorted(_t, cls, side='right')
+        _in = (i_cls >= 1) & (i_cls < n)
+        np.add.at(change, i_cls[_in], -clsComm[_in] + qty[_in]*(clsPrice[_in] - _p[i_cls[_in]-1]))
+        # holding over the intervals with excTime < _t[i-1] and _t[i] <= clsTime: the open quantity times the price change
+        first, last = np.maximum(i_exc + 1, 1), np.minimum(i_cls - 1, n - 1)
+        _in = first <= last
+        position = np.zeros(n + 1)
+        np.add.at(position, first[_in], qty[_in])
+        np.add.at(position, last[_in] + 1, -qty[_in])
+        change[1:] += np.cumsum(position)[1:n]*np.diff(_p)
+        return change[1:]
      
     def gross_profit(self):
         '''
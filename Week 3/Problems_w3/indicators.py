@@ -1,25 +1,151 @@
+import bisect
+from collections import deque, OrderedDict
+
 import numpy as np
 import pandas as pd
 import matplotlib.patches as patches
 
+class _PriceBuffer:
+    """ growable numpy record of (_t, _p, _T) rows with amortized O(1) appends, keeps the last maxlen rows if set """
+    def __init__(self, capacity=1024, maxlen=None):
+        self.maxlen = maxlen
+        if maxlen is not None:
+            capacity = 2*maxlen
+        self.data = np.zeros(capacity, dtype=[('_t', 'i8'), ('_p', 'f8'), ('_T', 'i8')])
+        self.size = 0
+
+    def append(self, _t, _p, _T):
+        if self.size == self.data.shape[0]:
+            if self.maxlen is None:
+                # double the capacity so the copies add up to O(1) per row
+                self.data = np.concatenate([self.data, np.zeros_like(self.data)])
+            else:
+                # move the tail to the front once every maxlen rows
+                self.data[:self.maxlen-1] = self.data[self.size-self.maxlen+1:self.size]
+                self.size = self.maxlen - 1
+        self.data[self.size] = (_t, _p, _T)
+        self.size += 1
+
+    def extend(self, _t, _p, _T):
+        if self.maxlen is not None:
+            for row in zip(_t[-self.maxlen:], _p[-self.maxlen:], _T[-self.maxlen:]):
+                self.append(*row)
+            return
+        n = len(_p)
+        if self.size + n > self.data.shape[0]:
+            _data = np.zeros(max(2*self.data.shape[0], self.size + n), dtype=self.data.dtype)
+            _data[:self.size] = self.data[:self.size]
+            self.data = _data
+        self.data['_t'][self.size:self.size+n] = _t
+        self.data['_p'][self.size:self.size+n] = _p
+        self.data['_T'][self.size:self.size+n] = _T
+        self.size += n
+
+    def clear(self):
+        self.size = 0
+
+    def last(self, col):
+        return self.data[col][self.size-1]
+
+    def view(self):
+        if self.maxlen is None:
+            return self.data[:self.size]
+        return self.data[max(self.size-self.maxlen, 0):self.size]
+
+    def to_df(self):
+        return pd.DataFrame(self.view())
+
+    def __len__(self):
+        return self.view().shape[0]
+
+class _RollingMedianTR:
+    """ median true range of the last period klines, as in Renko.__get_optimal_brick_size """
+    def __init__(self, period=60):
+        self.period = period
+        self.nBar = 0
+        self.lastClose = None
+        # a period of klines gives period-1 true ranges
+        self.values = deque()
+        self.sorted = []
+
+    def do_next(self, high, low, close):
+        if self.lastClose is not None:
+            _tr = max(high - low, abs(high - self.lastClose), abs(low - self.lastClose))
+            if not np.isnan(_tr):
+                self.values.append(_tr)
+                bisect.insort(self.sorted, _tr)
+                if len(self.values) > self.period - 1:
+                    del self.sorted[bisect.bisect_left(self.sorted, self.values.popleft())]
+        self.lastClose = close
+        self.nBar += 1
+        return self.get_value()
+
+    def get_value(self):
+        n = len(self.sorted)
+        if self.nBar <= self.period or n == 0:
+            return 0.0
+        if n % 2 == 1:
+            return self.sorted[n//2]
+        return (self.sorted[n//2-1] + self.sorted[n//2])/2
+
 class Renko:
-    """ renko price chart transformation """
-    def __init__(self):
-        self.source_prices = pd.DataFrame(columns=['_t', '_p', '_T'])
-        self.renko_prices = pd.DataFrame(columns=['_t', '_p', '_T'])
-        self.renko_directions = []
+    """ renko price chart transformation, streaming mode keeps only the last maxlen bricks if maxlen is set """
+    def __init__(self, maxlen=None, atr_timeperiod=60):
+        self.maxlen = maxlen
+        self.source = _PriceBuffer() if maxlen is None else None
+        self.renko = _PriceBuffer(maxlen=maxlen)
+        self.renko_directions = [] if maxlen is None else deque(maxlen=maxlen)
+        self.trMedian = _RollingMedianTR(atr_timeperiod)
+        # running counters for evaluate()
+        self.nSource, self.nBricks = 0, 0
+        self.balance, self.sign_changes = 0, 0
+
+    # DataFrame views of the buffers
+    @property
+    def source_prices(self):
+        if self.source is None:
+            return None
+        return self.source.to_df()
+
+    @property
+    def renko_prices(self):
+        return self.renko.to_df()
     
     # Setting brick size. Auto mode is preferred, it uses history
     def set_brick_size(self, HLC_history = None, auto = True, brick_size = 10.0):
         if auto == True:
-            self.brick_size = self.__get_optimal_brick_size(HLC_history)
+            self.brick_size = self.__get_optimal_brick_size(HLC_history, atr_timeperiod = self.trMedian.period)
+            # Seed the rolling median for update_brick_size
+            self.trMedian = _RollingMedianTR(self.trMedian.period)
+            _tail = HLC_history.iloc[-self.trMedian.period:]
+            self.trMedian.nBar = HLC_history.shape[0] - _tail.shape[0]
+            for h, l, c in _tail[['_h', '_l', '_c']].values:
+                self.trMedian.do_next(h, l, c)
         else:
             self.brick_size = brick_size
         return self.brick_size
+
+    # Updating brick size with a new kline, O(1) in the number of klines seen
+    def update_brick_size(self, high, low, close):
+        _brick_size = self.trMedian.do_next(high, low, close)
+        if _brick_size > 0:
+            self.brick_size = _brick_size
+        return self.brick_size
+
+    def __add_brick(self, _t, _p, _T, direction):
+        self.renko.append(_t, _p, _T)
+        if self.nBricks >= 2:
+            if direction == self.renko_directions[-1]:
+                self.balance = self.balance + 1
+            else:
+                self.balance = self.balance - 2
+                self.sign_changes = self.sign_changes + 1
+        self.renko_directions.append(direction)
+        self.nBricks += 1
     
-    def __renko_rule(self, last_price):
+    def __renko_rule(self, last_p, last_T):
         # Get the gap between two prices
-        gap_div = int(float(last_price['_p'] - self.renko_prices['_p'].iloc[-1]) / self.brick_size)
+        gap_div = int(float(last_p - self.renko.last('_p')) / self.brick_size)
         is_new_brick = False
         start_brick = 0
         num_new_bars = 0
@@ -37,18 +163,14 @@ class Renko:
                 num_new_bars -= np.sign(gap_div)
                 start_brick = 2
                 is_new_brick = True
-                self.renko_prices = self.renko_prices.append({'_t': self.renko_prices['_T'].iloc[-1], '_p': self.renko_prices['_p'].iloc[-1] \
-                                                             + 2 * self.brick_size * np.sign(gap_div), '_T': last_price['_T']}, ignore_index=True)
-                self.renko_directions.append(np.sign(gap_div))
+                self.__add_brick(self.renko.last('_T'), self.renko.last('_p') + 2 * self.brick_size * np.sign(gap_div), last_T, np.sign(gap_div))
             #else:
                 #num_new_bars = 0
 
             if is_new_brick:
                 # Add each brick
                 for d in range(start_brick, np.abs(gap_div)):
-                    self.renko_prices = self.renko_prices.append({'_t': self.renko_prices['_T'].iloc[-1], '_p': self.renko_prices['_p'].iloc[-1] \
-                                                                  + self.brick_size * np.sign(gap_div), '_T': last_price['_T']}, ignore_index=True)
-                    self.renko_directions.append(np.sign(gap_div))
+                    self.__add_brick(self.renko.last('_T'), self.renko.last('_p') + self.brick_size * np.sign(gap_div), last_T, np.sign(gap_div))
         
         return num_new_bars
                 
@@ -56,25 +178,28 @@ class Renko:
     def build_history(self, prices):
         if prices.shape[0] > 0:
             # Init by start values
-            self.source_prices = prices.copy()
-            self.renko_prices = self.renko_prices.append(prices.iloc[0], ignore_index=True)
-            self.renko_directions.append(0)
+            _t, _p, _T = prices['_t'].values, prices['_p'].values.astype(float), prices['_T'].values
+            if self.source is not None:
+                self.source.clear()
+                self.source.extend(_t, _p, _T)
+            self.nSource = _p.shape[0]
+            self.__add_brick(_t[0], _p[0], _T[0], 0)
             # For each price in history
-            for i in range(1, self.source_prices.shape[0]):
-                self.__renko_rule(self.source_prices.iloc[i])
+            for i in range(1, _p.shape[0]):
+                self.__renko_rule(_p[i], _T[i])
         
-        return self.renko_prices.shape[0]
+        return self.nBricks
     
     # Getting next renko value for last price
     def do_next(self, last_price):
-        if self.renko_prices.shape[0] == 0:
-            self.source_prices = self.source_prices.append(last_price, ignore_index=True)
-            self.renko_prices = self.renko_prices.append(last_price, ignore_index=True)
-            self.renko_directions.append(0)
+        if self.source is not None:
+            self.source.append(last_price['_t'], last_price['_p'], last_price['_T'])
+        self.nSource += 1
+        if self.nBricks == 0:
+            self.__add_brick(last_price['_t'], last_price['_p'], last_price['_T'], 0)
             return 1
         else:
-            self.source_prices = self.source_prices.append(last_price, ignore_index=True)
-            return self.__renko_rule(last_price)
+            return self.__renko_rule(float(last_price['_p']), last_price['_T'])
     
     # Simple method to get optimal brick size based on ATR
     def __get_optimal_brick_size(self, HLC_history, atr_timeperiod = 60):
@@ -91,18 +216,12 @@ class Renko:
         return brick_size
 
     def evaluate(self, method = 'simple'):
-        balance = 0
-        sign_changes = 0
-        price_ratio = self.source_prices.shape[0] / self.renko_prices.shape[0]
+        # balance and sign changes are counted as bricks are added
+        balance = self.balance
+        sign_changes = self.sign_changes
+        price_ratio = self.nSource / self.nBricks
 
         if method == 'simple':
-            for i in range(2, len(self.renko_directions)):
-                if self.renko_directions[i] == self.renko_directions[i - 1]:
-                    balance = balance + 1
-                else:
-                    balance = balance - 2
-                    sign_changes = sign_changes + 1
-
             if sign_changes == 0:
                 sign_changes = 1
 
@@ -116,18 +235,19 @@ class Renko:
                     'price_ratio': price_ratio, 'score': score}
     
     def get_prices(self):
-        return self.renko_prices
+        return self.renko.to_df()
     
     def get_directions(self):
         return self.renko_directions
     
     def plot_renko(self, ax, col_up = 'g', col_down = 'r'): 
         # Plot each renko bar
-        for i in range(1, self.renko_prices.shape[0]):
+        _p = self.renko.view()['_p']
+        for i in range(1, len(self.renko)):
             # Set basic params for patch rectangle
             col = col_up if self.renko_directions[i] == 1 else col_down
             x = i
-            y = self.renko_prices['_p'].iloc[i] - self.brick_size if self.renko_directions[i] == 1 else self.renko_prices['_p'].iloc[i]
+            y = _p[i] - self.brick_size if self.renko_directions[i] == 1 else _p[i]
             height = self.brick_size
                 
             # Draw bar with params
@@ -145,13 +265,98 @@ def mean_test(df, feat=None, alpha=0.1):
     '''
     Returns Dicky-Fuller test
     '''
+    from statsmodels.tsa.stattools import adfuller
     if feat is None: _df = df
     else: _df = df[feat]
     _mean_rv = (adfuller(_df)[1] < alpha)
     if not _mean_rv:
         return False
     return True
-        
+
+class ADFCache:
+    """ LRU cache of ADF (t-stat, p-value) keyed on (symbol, window end, lag) """
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.results = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def get(self, key):
+        if key in self.results:
+            self.results.move_to_end(key)
+            self.hits += 1
+            return self.results[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self.results[key] = value
+        self.results.move_to_end(key)
+        while len(self.results) > self.maxsize:
+            self.results.popitem(last=False)
+
+def rolling_adf(x, window, lag=1, ends=None):
+    '''
+    Returns ADF t-stats and p-values of every window of x ending at each index in ends (all by default),
+    same as adfuller(x[e-window+1:e+1], maxlag=lag, autolag=None, regression='c')
+    '''
+    from statsmodels.tsa.adfvalues import mackinnonp
+    x = np.asarray(x, dtype=float)
+    x = x - np.nanmean(x)
+    n, k, m = x.shape[0], lag + 2, window - lag - 1
+    if ends is None:
+        ends = np.arange(n)
+    ends = np.asarray(ends, dtype=int)
+    tstat, pvalue = np.full(ends.shape[0], np.nan), np.full(ends.shape[0], np.nan)
+    ok = (ends >= window - 1) & (ends < n)
+    if m <= k or not ok.any():
+        return tstat, pvalue
+    # regression rows t = lag+1..n-1: dx[t] on [1, x[t-1], dx[t-1], ..., dx[t-lag]]
+    dx = np.diff(x)
+    rows = n - lag - 1
+    _X = np.empty((rows, k))
+    _X[:, 0] = 1.
+    _X[:, 1] = x[lag:n-1]
+    for i in range(1, lag + 1):
+        _X[:, i+1] = dx[lag-i:n-1-i]
+    _y = dx[lag:]
+    # cumulative cross products shared by all overlapping windows
+    cXX = np.concatenate([np.zeros((1, k, k)), np.cumsum(_X[:, :, None]*_X[:, None, :], axis=0)])
+    cXy = np.concatenate([np.zeros((1, k)), np.cumsum(_X*_y[:, None], axis=0)])
+    cyy = np.concatenate([[0.], np.cumsum(_y*_y)])
+    # window ending at x[e] uses regression rows e-m+1..e, i.e. cumulative rows e-lag-m..e-lag
+    hi = ends[ok] - lag
+    lo = hi - m
+    XX, Xy, yy = cXX[hi] - cXX[lo], cXy[hi] - cXy[lo], cyy[hi] - cyy[lo]
+    XXinv = np.linalg.inv(XX)
+    beta = np.einsum('nij,nj->ni', XXinv, Xy)
+    rss = yy - np.einsum('ni,ni->n', beta, Xy)
+    _t = beta[:, 1]/np.sqrt(np.maximum(rss, 0.)/(m - k)*XXinv[:, 1, 1])
+    tstat[ok] = _t
+    pvalue[ok] = [mackinnonp(t, regression='c', N=1) if not np.isnan(t) else np.nan for t in _t]
+    return tstat, pvalue
+
+def rolling_mean_test(df, window, feat='_c', lag=1, alpha=0.1, symbol=None, cache=None, last=None):
+    '''
+    Returns Dicky-Fuller test (fixed lag) for the windows ending at the last rows of df (all rows if last is None),
+    reusing cached results keyed on (symbol, feat, window, window end _t, lag)
+    '''
+    n = df.shape[0]
+    ends = np.arange(n) if last is None else np.arange(max(n - last, 0), n)
+    _t = df['_t'].values if '_t' in df else np.arange(n)
+    pvalue = np.full(ends.shape[0], np.nan)
+    todo = np.ones(ends.shape[0], dtype=bool)
+    if cache is not None:
+        for j, e in enumerate(ends):
+            _res = cache.get((symbol, feat, window, _t[e], lag))
+            if _res is not None:
+                pvalue[j], todo[j] = _res[1], False
+    if todo.any():
+        tstat, pvalue[todo] = rolling_adf(df[feat].values, window, lag=lag, ends=ends[todo])
+        if cache is not None:
+            for e, t, p in zip(ends[todo], tstat, pvalue[todo]):
+                cache.put((symbol, feat, window, _t[e], lag), (t, p))
+    return pvalue < alpha
+
 def OBVol(df):
     '''
     Returns on-balance volume
@@ -10,7 +10,8 @@ import pandas as pd
 
 from binancepy import MarketData, Client
 from utility import print_, barstr, timestr
-from tradingpy import TradingModel, Portfolio
+from tradingpy import TradingModel, Portfolio, build_initial_inputs
+from klines import KlineCache
 from wss import wss_run
 
 ## Model setups
@@ -60,7 +61,6 @@ def main(args):
         client.change_leverage(symbol, 1)
         _data = MarketData(testnet=testnet, symbol=symbol)
         model = TradingModel(symbol=symbol, testnet=testnet, modelType='bollinger', marketData=_data, pdObserve=pd_ob, pdEstimate=pd_es, orderSize=portfolio.orderSize)
-        model.build_initial_input()
         only_pos = 'BOTH'
         if symbol in portfolio.locks['BUY']:
             model.add_signal_lock(slock='BUY')
@@ -70,6 +70,9 @@ def main(args):
             only_pos = 'BUY ONLY'
         models[symbol] = model
         print_('\tFinish generating model for %s - positions: %s' % (symbol, only_pos), fileout)
+    # testnet prices differ from the exchange ones, keep their klines apart as the reports are
+    build_initial_inputs(models.values(), cache=KlineCache('data/klines/testnet' if testnet else 'data/klines'))
+    print_('\tFinish downloading historical data', fileout)
 
     print_('\n' + barstr('Start Data Streaming', length=100, space_size=5) + '\n', fileout)
     header_print(testnet, client, portfolio, fileout)
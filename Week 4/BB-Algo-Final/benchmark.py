@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks of indicators.py and TradingModel.get_last_signal on the bundled klines
+
+    python benchmark.py [tiles] [--save] [--float32]
+
+The 1m klines of Week 1/Problems_w1/data/klines are tiled to a longer history, every indicator is timed
+in batch mode (whole history) and in streaming mode (one kline at a time after a warm-up), and the time
+per bar and peak traced memory are compared with benchmark_baseline.json (rewritten with --save)
+"""
+import time, sys, os, json, tracemalloc
+import numpy as np
+import pandas as pd
+
+import indicators as ind
+from features import FeaturePipeline
+from tradingpy import TradingModel, csv_to_df
+
+DATADIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'Week 1', 'Problems_w1', 'data', 'klines')
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+FEATURES = { 'bb': ('Bbands', {'window': 20, 'numsd': 2.5}),
+             'macd': ('MACD', {}),
+             'rsi': ('RSIfunc', {}),
+             'will': ('Williams', {'period': 15}),
+             'stoch': ('StochOsc', {'period': 15}),
+             'atr': ('average_true_range', {'period': 15, 'alpha': 0.3, 'highlow': False}),
+             'obv': ('OBVol', {}) }
+
+def tiled_klines(symbol='BTCUSDT', tiles=10, dtype=np.float64):
+    '''
+    Return the klines of a symbol repeated tiles times, each copy rescaled to start at the last close of the previous one
+    '''
+    df = csv_to_df(os.path.join(DATADIR, '-%s-1m.csv' % symbol), dtype=np.float64)
+    n, span = df.shape[0], int(df['_t'].iloc[-1] - df['_t'].iloc[0]) + 60*1000
+    prices = df[['_o', '_h', '_l', '_c']].values
+    parts, scale = [], 1.
+    for i in range(tiles):
+        _df = df.copy()
+        _df['_t'] = df['_t'] + i*span
+        _df[['_o', '_h', '_l', '_c']] = prices*scale
+        scale *= prices[-1, 3]/prices[0, 0]
+        parts.append(_df)
+    df = pd.concat(parts, ignore_index=True)
+    df[['_o', '_h', '_l', '_c', '_v']] = df[['_o', '_h', '_l', '_c', '_v']].astype(dtype)
+    return df
+
+def batch_cases(df):
+    '''
+    Return name -> function of the batch benchmarks on df
+    '''
+    windows, numsds = np.arange(10, 61, 5), np.array([2., 2.5, 3.])
+    pipe = FeaturePipeline(FEATURES)
+    return { 'batch/OBVol': lambda: ind.OBVol(df),
+             'batch/MACD': lambda: ind.MACD(df),
+             'batch/Williams': lambda: ind.Williams(df, period=15),
+             'batch/StochOsc': lambda: ind.StochOsc(df, period=15),
+             'batch/RSIfunc': lambda: ind.RSIfunc(df),
+             'batch/Bbands': lambda: ind.Bbands(df['_c'], window=20, numsd=2.5),
+             'batch/bbands_grid': lambda: ind.bbands_grid(df['_c'], windows, numsds),
+             'batch/average_true_range': lambda: ind.average_true_range(df, period=15, alpha=0.3, highlow=False),
+             'batch/expanding_atr': lambda: ind.expanding_atr(df, period=15, alpha=0.3, highlow=False),
+             'batch/FeaturePipeline': lambda: pipe.compute(df) }
+
+def stream_cases(df, warmup, nmodel=2000):
+    '''
+    Return name -> (function, number of bars) of the streaming benchmarks, seeded on df[:warmup] and fed
+    with the rest (the first nmodel klines for TradingModel.get_last_signal)
+    '''
+    hist, new = df.iloc[:warmup], df.iloc[warmup:]
+    _h, _l, _c, _v = (new[f].values for f in ('_h', '_l', '_c', '_v'))
+
+    def run(stream, seed, step):
+        seed(stream)
+        for i in range(_c.shape[0]):
+            step(stream, i)
+
+    def model():
+        _model = TradingModel(symbol='BTCUSDT', testnet=True, modelType='bollinger', marketData=None, \
+                              pdObserve=30, pdEstimate=15, inputData=hist.reset_index(drop=True))
+        for i in range(min(nmodel, new.shape[0])):
+            _model.get_last_signal(new.iloc[i:i+1])
+
+    cases = { 'stream/StreamEMA': lambda: run(ind.StreamEMA(12), lambda s: s.build_history(hist['_c']), lambda s, i: s.do_next(_c[i])),
+              'stream/StreamMACD': lambda: run(ind.StreamMACD(), lambda s: s.build_history(hist), lambda s, i: s.do_next(_c[i])),
+              'stream/StreamRSI': lambda: run(ind.StreamRSI(14), lambda s: s.build_history(hist['_c']), lambda s, i: s.do_next(_c[i])),
+              'stream/StreamOBV': lambda: run(ind.StreamOBV(), lambda s: s.build_history(hist['_c'], hist['_v']), lambda s, i: s.do_next(_c[i], _v[i])),
+              'stream/RollingExtremes': lambda: run(ind.RollingExtremes(15), lambda s: s.build_history(hist['_h'], hist['_l']), lambda s, i: s.do_next(_h[i], _l[i])),
+              'stream/StreamBbands': lambda: run(ind.StreamBbands(20, numsd=2.5), lambda s: s.build_history(hist['_c']), lambda s, i: s.do_next(_c[i])),
+              'stream/StreamATR': lambda: run(ind.StreamATR(15, alpha=0.3, highlow=False), lambda s: s.build_history(hist), lambda s, i: s.do_next(_h[i], _l[i], _c[i])),
+              'stream/FeaturePipeline': lambda: run(FeaturePipeline(FEATURES), lambda s: s.build_history(hist), lambda s, i: s.do_next(_h[i], _l[i], _c[i], _v[i])),
+              'stream/TradingModel.get_last_signal': model }
+    return {name: (func, min(nmodel, new.shape[0]) if func is model else new.shape[0]) for name, func in cases.items()}
+
+def measure(func, nbar, repeat=3):
+    '''
+    Return the best time per bar (microseconds) over repeat runs and the peak traced memory (MB) of one run
+    '''
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'us_per_bar': float('%.4g' % (1e6*best/nbar)), 'peak_mb': float('%.4g' % (peak/1024**2))}
+
+def main(args):
+    '''
+    Main function : run the benchmarks, compare with the stored baseline and optionally replace it
+    '''
+    tiles = int(args[0]) if args and args[0].isdigit() else 10
+    dtype = np.float32 if '--float32' in args else np.float64
+    df = tiled_klines(tiles=tiles, dtype=dtype)
+    warmup = min(1000, df.shape[0]//2)
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+    label = '%s-%d' % (np.dtype(dtype).name, df.shape[0])
+    results = {}
+    print('%d bars (%s), baseline %s' % (df.shape[0], np.dtype(dtype).name, 'found' if label in baseline else 'missing'))
+    print('%-40s %12s %10s %10s' % ('benchmark', 'us/bar', 'peak MB', 'vs base'))
+    cases = [(name, func, df.shape[0]) for name, func in batch_cases(df).items()] + \
+            [(name, func, nbar) for name, (func, nbar) in stream_cases(df, warmup).items()]
+    for name, func, nbar in cases:
+        results[name] = measure(func, nbar)
+        base = baseline.get(label, {}).get(name)
+        ratio = '%9.2fx' % (results[name]['us_per_bar']/base['us_per_bar']) if base else '%10s' % '-'
+        print('%-40s %12.3f %10.2f %s' % (name, results[name]['us_per_bar'], results[name]['peak_mb'], ratio))
+    if '--save' in args:
+        baseline[label] = results
+        with open(BASELINE, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('baseline saved to %s' % BASELINE)
+    return results
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -11,6 +11,9 @@ Docmentation of Binance Futures Websocket can be found here: https://binance-doc
 """
 
 import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
@@ -21,6 +24,37 @@ import json
 import hmac
 import hashlib
 
+# request weight of a klines call by its largest limit
+KLINE_WEIGHTS = [(99, 1), (499, 2), (1000, 5), (1500, 10)]
+INTERVAL_MS = { '1m': 60*1000, '3m': 3*60*1000, '5m': 5*60*1000, '15m': 15*60*1000, '30m': 30*60*1000, \
+                '1h': 3600*1000, '2h': 2*3600*1000, '4h': 4*3600*1000, '6h': 6*3600*1000, '8h': 8*3600*1000, \
+                '12h': 12*3600*1000, '1d': 86400*1000, '3d': 3*86400*1000, '1w': 7*86400*1000 }
+
+class WeightBudget:
+    """ request weight shared by all threads, blocks while limit is spent within the last period seconds """
+    def __init__(self, limit=2400, period=60.):
+        self.limit = limit
+        self.period = period
+        self.lock = threading.Lock()
+        self.spent = deque()
+        self.used = 0
+
+    def acquire(self, weight):
+        '''
+        Waits until weight can be spent, then records it
+        '''
+        while True:
+            with self.lock:
+                now = time.time()
+                while self.spent and self.spent[0][0] <= now - self.period:
+                    self.used -= self.spent.popleft()[1]
+                if self.used + weight <= self.limit or not self.spent:
+                    self.spent.append((now, weight))
+                    self.used += weight
+                    return
+                wait = self.spent[0][0] + self.period - now
+            time.sleep(max(wait, 0.01))
+
 #%%%%     
 class MarketData:
     def __init__(self,
@@ -117,6 +151,55 @@ class MarketData:
                                             ->  endTime = 1573661428706
         '''
         return requests.get(f'{self.http_way}klines?symbol={self.symbol}&interval={interval}&startTime={startTime}&endTime={endTime}&limit={limit}').json()
+
+    @staticmethod
+    def candles_pages(interval, startTime, endTime):
+        '''
+        Returns the (startTime, endTime, limit, weight) requests covering [startTime, endTime] for the least total weight
+        '''
+        if interval not in INTERVAL_MS:
+            # months have no fixed length to page on, request them with candles_data
+            raise ValueError('Cannot page klines of interval %s, use one of %s' % (interval, ', '.join(INTERVAL_MS)))
+        step = INTERVAL_MS[interval]
+        num_klns = int((endTime - startTime)//step) + 1
+        limit, weight = min(KLINE_WEIGHTS, key=lambda lw: (-(-num_klns//lw[0])*lw[1], -lw[0]))
+        limit = min(limit, num_klns)
+        pages = []
+        for t in range(int(startTime), int(endTime) + 1, limit*step):
+            pages.append((t, min(t + limit*step - 1, int(endTime)), limit, weight))
+        return pages
+
+    def candles_history(self,
+                        interval: str = '1m',
+                        startTime: int = None,
+                        endTime: int = None,
+                        budget: WeightBudget = None,
+                        workers: int = 1):
+        '''
+        Returns the klines of [startTime, endTime] of any length, ordered and de-duplicated by open time
+
+        To share the request weight with other symbols  ->  budget = WeightBudget()
+
+        To fetch pages concurrently                     ->  workers = 4
+        '''
+        def fetch(page):
+            if budget is not None:
+                budget.acquire(page[3])
+            klns = self.candles_data(interval=interval, startTime=page[0], endTime=page[1], limit=page[2])
+            if not isinstance(klns, list):
+                raise ValueError('klines request failed: %s' % str(klns))
+            return klns
+        pages = self.candles_pages(interval, startTime, endTime)
+        if workers > 1 and len(pages) > 1:
+            with ThreadPoolExecutor(min(workers, len(pages))) as pool:
+                results = list(pool.map(fetch, pages))
+        else:
+            results = [fetch(p) for p in pages]
+        merged = {}
+        for klns in results:
+            for k in klns:
+                merged[int(k[0])] = k
+        return [merged[t] for t in sorted(merged)]
     
     def mark_price(self):
         return requests.get(f'{self.http_way}premiumIndex?symbol={self.symbol}').json()
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Feature pipeline on top of indicators.py: every requested feature is expanded into the intermediate
+nodes it reads (rolling moments, EMAs, rolling extremes, ATR ranges...), and each node is computed
+once for all the features sharing it, on a whole kline frame or one closed kline at a time
+"""
+import numpy as np
+
+from indicators import _by_time, rolling_extremes, RollingExtremes, StreamEMA, StreamBbands, StreamRSI, \
+                       StreamATR, StreamOBV, Williams, StochOsc, rsi_array, obv_array, atr_ranges, \
+                       average_true_range
+
+DEFAULTS = { 'Bbands': {'window': 20, 'width': None, 'numsd': 2.},
+             'MACD': {'fpd': 12, 'spd': 26},
+             'RSIfunc': {'period': 14},
+             'Williams': {'period': 14},
+             'StochOsc': {'period': 14},
+             'average_true_range': {'period': 10, 'alpha': 0.5, 'highlow': True},
+             'OBVol': {} }
+
+def feature_nodes(indicator, params, stream=False):
+    '''
+    Returns the intermediate nodes read by a feature, dependencies first
+    '''
+    if indicator == 'Bbands':
+        return [('moments', params['window'])]
+    if indicator == 'MACD':
+        return [('ema', params['fpd']), ('ema', params['spd'])]
+    if indicator == 'RSIfunc':
+        return [('rsi', params['period'])]
+    if indicator in ('Williams', 'StochOsc'):
+        return [('extremes', params['period'])]
+    if indicator == 'average_true_range':
+        if stream:
+            return [('extremes', params['period']), ('atr', params['period'], params['alpha'], params['highlow'])]
+        return [('extremes', params['period']), ('ranges', params['period'], params['highlow'])]
+    if indicator == 'OBVol':
+        return [('obv',)]
+    raise ValueError('Unknown indicator %s' % indicator)
+
+class FeaturePipeline:
+    """ set of indicator features sharing their intermediate nodes """
+    def __init__(self, features):
+        '''
+        Feature Pipeline class
+
+            features : dict of name -> (indicator, params), indicator one of DEFAULTS,
+                       e.g. {'bb': ('Bbands', {'window': 20, 'numsd': 2.5}), 'atr': ('average_true_range', {'alpha': 0.3})}
+        '''
+        self.features = {}
+        for name, (indicator, params) in features.items():
+            if indicator not in DEFAULTS:
+                raise ValueError('Unknown indicator %s' % indicator)
+            self.features[name] = (indicator, {**DEFAULTS[indicator], **(params or {})})
+        self.nodes = self.build_graph(stream=False)
+        self.streams = None
+        self.values = {}
+
+    def build_graph(self, stream=False):
+        '''
+        Returns the distinct intermediate nodes of all features, dependencies first
+        '''
+        nodes = []
+        for indicator, params in self.features.values():
+            for node in feature_nodes(indicator, params, stream=stream):
+                if node not in nodes:
+                    nodes.append(node)
+        return nodes
+
+    def compute(self, df):
+        '''
+        Returns all features on a kline frame (or dict of (symbols x time) arrays), each shared node computed once
+        '''
+        _nodes = {}
+        for node in self.nodes:
+            kind = node[0]
+            if kind == 'moments':
+                _nodes[node] = ( _by_time(df['_c'], lambda x: x.rolling(node[1]).mean()),
+                                 _by_time(df['_c'], lambda x: x.rolling(node[1]).std(ddof=0)) )
+            elif kind == 'ema':
+                _nodes[node] = _by_time(df['_c'], lambda x: x.ewm(span=node[1]).mean())
+            elif kind == 'rsi':
+                _nodes[node] = rsi_array(df['_c'], period=node[1])
+            elif kind == 'extremes':
+                _nodes[node] = rolling_extremes(df['_h'], df['_l'], period=node[1])
+            elif kind == 'ranges':
+                _nodes[node] = atr_ranges(df, period=node[1], highlow=node[2], extremes=_nodes[('extremes', node[1])])
+            elif kind == 'obv':
+                _nodes[node] = obv_array(df['_c'], df['_v'])
+        out = {}
+        for name, (indicator, params) in self.features.items():
+            if indicator == 'Bbands':
+                ave, sd = _nodes[('moments', params['window'])]
+                out[name] = self._bands(ave, sd, params)
+            elif indicator == 'MACD':
+                out[name] = _nodes[('ema', params['fpd'])] - _nodes[('ema', params['spd'])]
+            elif indicator == 'RSIfunc':
+                out[name] = _nodes[('rsi', params['period'])]
+            elif indicator == 'Williams':
+                out[name] = Williams(df, extremes=_nodes[('extremes', params['period'])])
+            elif indicator == 'StochOsc':
+                out[name] = StochOsc(df, extremes=_nodes[('extremes', params['period'])])
+            elif indicator == 'average_true_range':
+                out[name] = average_true_range(df, period=params['period'], alpha=params['alpha'], \
+                                               ranges=_nodes[('ranges', params['period'], params['highlow'])])
+            elif indicator == 'OBVol':
+                out[name] = _nodes[('obv',)]
+        return out
+
+    def build_history(self, df):
+        '''
+        Seeds the incremental nodes from a kline history (e.g. TradingModel.inputData), returns the last features
+        '''
+        self.streams = {}
+        for node in self.build_graph(stream=True):
+            kind = node[0]
+            if kind == 'moments':
+                self.streams[node] = StreamBbands(window=node[1], numsd=1.)
+                self.streams[node].build_history(df['_c'])
+            elif kind == 'ema':
+                self.streams[node] = StreamEMA(node[1])
+                self.streams[node].build_history(df['_c'])
+            elif kind == 'rsi':
+                self.streams[node] = StreamRSI(node[1])
+                self.streams[node].build_history(df['_c'])
+            elif kind == 'extremes':
+                self.streams[node] = RollingExtremes(node[1])
+                self.streams[node].build_history(df['_h'], df['_l'])
+            elif kind == 'atr':
+                self.streams[node] = StreamATR(period=node[1], alpha=node[2], highlow=node[3], \
+                                               extremes=self.streams[('extremes', node[1])])
+                self.streams[node].build_history(df)
+            elif kind == 'obv':
+                self.streams[node] = StreamOBV()
+                self.streams[node].build_history(df['_c'], df['_v'])
+        self.lastClose = float(df['_c'].values[-1]) if df.shape[0] > 0 else np.nan
+        return self.get_value()
+
+    def do_next(self, high, low, close, volume=np.nan):
+        '''
+        Adds a new kline to every node once, returns the last features
+        '''
+        for node, _stream in self.streams.items():
+            kind = node[0]
+            if kind in ('moments', 'ema', 'rsi'):
+                _stream.do_next(close)
+            elif kind == 'extremes':
+                _stream.do_next(high, low)
+            elif kind == 'atr':
+                _stream.do_next(high, low, close)
+            elif kind == 'obv':
+                _stream.do_next(close, volume)
+        self.lastClose = float(close)
+        return self.get_value()
+
+    def get_value(self):
+        '''
+        Returns the last value of every feature
+        '''
+        out = {}
+        for name, (indicator, params) in self.features.items():
+            if indicator == 'Bbands':
+                _, ave, up, _ = self.streams[('moments', params['window'])].get_bands()[-1]
+                out[name] = self._bands(ave, up - ave, params)
+            elif indicator == 'MACD':
+                out[name] = self.streams[('ema', params['fpd'])].get_value() - self.streams[('ema', params['spd'])].get_value()
+            elif indicator == 'RSIfunc':
+                out[name] = self.streams[('rsi', params['period'])].get_value()
+            elif indicator in ('Williams', 'StochOsc'):
+                high, low = self.streams[('extremes', params['period'])].get_value()
+                _df = {'_c': self.lastClose}
+                _func = Williams if indicator == 'Williams' else StochOsc
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    out[name] = _func(_df, extremes=(high, low))
+            elif indicator == 'average_true_range':
+                out[name] = self.streams[('atr', params['period'], params['alpha'], params['highlow'])].get_value()
+            elif indicator == 'OBVol':
+                out[name] = self.streams[('obv',)].get_value()
+        self.values = out
+        return out
+
+    @staticmethod
+    def _bands(ave, sd, params):
+        '''
+        Returns average, upper band, and lower band as Bbands does
+        '''
+        if params['width']:
+            return ave, ave*(1+params['width']), ave*(1-params['width'])
+        if params['numsd']:
+            return ave, ave + sd*params['numsd'], ave - sd*params['numsd']
+        return None
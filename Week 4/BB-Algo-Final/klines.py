@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Candle storage shared by TradingModel and the websocket threads
+"""
+import os, threading
+
+import numpy as np
+import pandas as pd
+
+KLINE_FEATS = ['_t', '_o', '_h', '_l', '_c', '_v']
+# position of every field in a REST kline array, and its key in a websocket 'k' dict
+# ('_v' is the quote asset volume on the websocket, as in wss.on_message)
+KLINE_REST = { '_t': 0, '_o': 1, '_h': 2, '_l': 3, '_c': 4, '_v': 5, 'close_time': 6, 'quote_av': 7, 'trades': 8, \
+               'tb_base_av': 9, 'tb_quote_av': 10, 'ignore': 11 }
+KLINE_WSS = { '_t': 't', '_o': 'o', '_h': 'h', '_l': 'l', '_c': 'c', '_v': 'q', 'close_time': 'T', 'quote_av': 'q', \
+              'trades': 'n', 'tb_base_av': 'V', 'tb_quote_av': 'Q', 'ignore': 'B' }
+KLINE_INTS = ('_t', 'close_time', 'trades')
+
+def parse_klines(market_data, feats=KLINE_FEATS, dtype=np.float64):
+    '''
+    Returns a dict of typed columns (int64 times and counts, dtype prices and volumes) from REST kline arrays
+    '''
+    n = len(market_data)
+    columns = {}
+    for f in feats:
+        i = KLINE_REST[f]
+        if f in KLINE_INTS:
+            columns[f] = np.fromiter((k[i] for k in market_data), dtype=np.int64, count=n)
+        else:
+            columns[f] = np.fromiter((float(k[i]) for k in market_data), dtype=dtype, count=n)
+    return columns
+
+def parse_kline(kln, feats=KLINE_FEATS):
+    '''
+    Returns a dict of typed values from a websocket kline ('k' field of a kline event)
+    '''
+    return {f: int(kln[KLINE_WSS[f]]) if f in KLINE_INTS else float(kln[KLINE_WSS[f]]) for f in feats}
+
+def kline_dtype(dtype=np.float64):
+    '''
+    Returns the structured dtype of a kline: int64 open time and dtype prices and volume
+    '''
+    return np.dtype([('_t', np.int64)] + [(f, dtype) for f in KLINE_FEATS[1:]])
+
+class KlineBuffer:
+    """ fixed-capacity ring buffer of closed klines, the last klines are always one contiguous array """
+    def __init__(self, capacity=1000, dtype=np.float64):
+        self.capacity = capacity
+        # every kline is written twice, at i and i+capacity, so any window of the last
+        # capacity klines is a slice of data without copy
+        self.data = np.zeros(2*capacity, dtype=kline_dtype(dtype))
+        self.n = 0
+        # taken by the writers (websocket thread) and by the readers that copy, see get_last_signal
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return min(self.n, self.capacity)
+
+    def append(self, kln):
+        '''
+        Adds a closed kline (dict or tuple in KLINE_FEATS order), returns False if it is not newer than the last one
+        '''
+        if isinstance(kln, dict):
+            kln = tuple(kln[f] for f in KLINE_FEATS)
+        with self.lock:
+            if self.n > 0 and kln[0] <= self.last_time():
+                return False
+            i = self.n % self.capacity
+            self.data[i] = kln
+            self.data[i + self.capacity] = kln
+            self.n += 1
+        return True
+
+    def extend(self, df):
+        '''
+        Adds the klines of a pd.DataFrame (or structured array) newer than the last one, returns the number added
+        '''
+        with self.lock:
+            _t = np.asarray(df['_t'], dtype=np.int64)
+            keep = np.ones(_t.shape[0], dtype=bool)
+            keep[1:] = np.diff(_t) > 0
+            if self.n > 0:
+                keep &= _t > self.last_time()
+            rows = np.zeros(int(keep.sum()), dtype=self.data.dtype)
+            for f in KLINE_FEATS:
+                rows[f] = np.asarray(df[f])[keep]
+            rows = rows[-self.capacity:]
+            skipped = int(keep.sum()) - rows.shape[0]
+            i = (self.n + skipped) % self.capacity
+            # the rows wrap at most once around the ring
+            head = min(rows.shape[0], self.capacity - i)
+            for _i, _rows in ((i, rows[:head]), (0, rows[head:])):
+                self.data[_i:_i+_rows.shape[0]] = _rows
+                self.data[_i+self.capacity:_i+self.capacity+_rows.shape[0]] = _rows
+            self.n += int(keep.sum())
+            return int(keep.sum())
+
+    def view(self, n=None, total=None):
+        '''
+        Returns the last n klines (all stored klines if None) as a structured array view, oldest first
+
+            total : value of self.n the window ends at, read once by the caller so that klines appended
+                    meanwhile by another thread neither shift the window nor enter it
+        '''
+        _n = self.n
+        total = _n if total is None else total
+        # klines appended after total have overwritten the oldest slots
+        size = max(min(total, self.capacity - (_n - total)), 0)
+        size = size if n is None else min(n, size)
+        end = (total - 1) % self.capacity + 1 + self.capacity
+        return self.data[end-size:end]
+
+    def last_time(self, total=None):
+        '''
+        Returns the open time of the last kline (of the first total klines if given, None if empty)
+        '''
+        total = self.n if total is None else total
+        return int(self.view(1, total=total)['_t'][0]) if total > 0 else None
+
+    def to_df(self, n=None, total=None):
+        '''
+        Returns a copy of the last n klines (up to total klines, see view) as a pd.DataFrame
+        '''
+        with self.lock:
+            return pd.DataFrame(self.view(n, total=total))
+
+    def clear(self):
+        '''
+        Removes all klines
+        '''
+        with self.lock:
+            self.n = 0
+
+class KlineCache:
+    """ on-disk kline history, one columnar .npz file per symbol and interval sorted by open time """
+    def __init__(self, path='data/klines'):
+        self.path = path
+
+    def filename(self, symbol, interval):
+        '''
+        Returns the file of a symbol and interval
+        '''
+        return os.path.join(self.path, '%s-%s.npz' % (symbol.upper(), interval))
+
+    def load(self, symbol, interval, startTime=None, feats=KLINE_FEATS):
+        '''
+        Returns the cached columns of the klines opened at or after startTime (empty columns if none)
+        '''
+        fname = self.filename(symbol, interval)
+        if not os.path.exists(fname):
+            return {f: np.zeros(0, dtype=np.int64 if f in KLINE_INTS else np.float64) for f in feats}
+        with np.load(fname) as data:
+            _t = data['_t']
+            i = 0 if startTime is None else int(np.searchsorted(_t, startTime))
+            return {f: data[f][i:] for f in feats}
+
+    def save(self, symbol, interval, columns):
+        '''
+        Merges closed klines into the cache (new values win on the same open time), returns the number of cached klines
+        '''
+        old = self.load(symbol, interval, feats=list(columns))
+        _t = np.concatenate([np.asarray(columns['_t'], dtype=np.int64), old['_t']])
+        # the first occurrence of an open time is the newest value
+        _t, idx = np.unique(_t, return_index=True)
+        merged = {f: np.concatenate([np.asarray(columns[f]), old[f]])[idx] for f in columns}
+        os.makedirs(self.path, exist_ok=True)
+        fname = self.filename(symbol, interval)
+        with open(fname + '.tmp', 'wb') as f:
+            np.savez(f, **merged)
+        os.replace(fname + '.tmp', fname)
+        return _t.shape[0]
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+Event-driven replay of historical klines through the live trading logic: TradingModel.get_last_signal,
+wss.new_signal and wss.manage_signals run unchanged against a simulated clock, market data and client
+"""
+import heapq, time
+from collections import deque
+import numpy as np
+import pandas as pd
+
+from tradingpy import PRICEPRE, SIDE, TradingModel, Portfolio
+from klines import KLINE_FEATS
+from wss import new_signal, manage_signals
+
+# event kinds, a kline closing at t is processed before the trades of t
+KLINE, TRADE = 0, 1
+
+class SimClock:
+    """ simulated server time (ms) shared by the replay market data and client """
+    def __init__(self, t=0):
+        self.t = int(t)
+
+class SimMarketData:
+    """ MarketData of one symbol answering from the trades replayed up to the simulated clock """
+    def __init__(self, symbol, clock, maxlen=100):
+        self.symbol = symbol.lower()
+        self.clock = clock
+        self.trades = deque(maxlen=maxlen)
+        self.tick = 10**-PRICEPRE[symbol.upper()]
+
+    def add_trade(self, _t, price):
+        '''
+        Adds a replayed trade
+        '''
+        self.trades.append((int(_t), float(price)))
+
+    def last_price(self):
+        '''
+        Returns the price of the last replayed trade
+        '''
+        return self.trades[-1][1]
+
+    def server_time(self):
+        '''
+        Returns the simulated server time
+        '''
+        return {'serverTime': self.clock.t}
+
+    def recent_trades(self, limit=500):
+        '''
+        Returns the last trades as MarketData.recent_trades does, oldest first
+        '''
+        n = min(limit, len(self.trades))
+        return [{'time': _t, 'price': _p} for _t, _p in list(self.trades)[len(self.trades)-n:]]
+
+    def order_book(self, limit=100):
+        '''
+        Returns a book of one price tick per level around the last price
+        '''
+        p, pre = self.last_price(), PRICEPRE[self.symbol.upper()]
+        bids = [[str(round(p - i*self.tick, pre)), '1'] for i in range(1, limit+1)]
+        asks = [[str(round(p + i*self.tick, pre)), '1'] for i in range(1, limit+1)]
+        return {'lastUpdateId': self.clock.t, 'bids': bids, 'asks': asks}
+
+class SimClient:
+    """ Client filling orders against the replayed trades: MARKET at the last price, LIMIT once a trade reaches the limit """
+    def __init__(self, clock, markets, initBalance=1000., currency='USDT', \
+                 commRate={'MARKET': 0.032/100, 'LIMIT': 0.016/100}):
+        self.clock = clock
+        self.markets = markets
+        self.currency = currency
+        self.commRate = commRate
+        self.wallet = float(initBalance)
+        self.orders = {}
+        self.openOrders = {symbol: [] for symbol in markets}
+        # (symbol, positionSide) -> [signed amount, entry price]
+        self.positions = {}
+        self.lastId = 0
+
+    def timestamp(self):
+        '''
+        Returns the simulated server time
+        '''
+        return self.clock.t
+
+    def new_order(self, symbol, side, orderType, quantity, positionSide='BOTH', timeInForce=None, price=None, **kwargs):
+        '''
+        Places an order, returns the order response
+        '''
+        self.lastId += 1
+        order = { 'orderId': self.lastId, 'symbol': symbol, 'status': 'NEW', 'side': side, 'type': orderType, \
+                  'positionSide': positionSide, 'origQty': float(quantity), 'price': price, 'timeInForce': timeInForce, \
+                  'avgPrice': 0., 'executedQty': 0., 'updateTime': self.clock.t }
+        self.orders[order['orderId']] = order
+        if orderType == 'MARKET':
+            self.fill(order, self.markets[symbol].last_price())
+        else:
+            self.openOrders[symbol].append(order)
+        return dict(order)
+
+    def query_order(self, symbol, orderId):
+        '''
+        Returns the order response of an order
+        '''
+        return dict(self.orders[orderId])
+
+    def cancel_order(self, symbol, orderId):
+        '''
+        Cancels an order if it is not filled, returns the order response
+        '''
+        order = self.orders[orderId]
+        if order['status'] == 'NEW':
+            order['status'], order['updateTime'] = 'CANCELED', self.clock.t
+            self.openOrders[symbol].remove(order)
+        return dict(order)
+
+    def match(self, symbol, price):
+        '''
+        Fills the open LIMIT orders of a symbol reached by a trade price
+        '''
+        for order in list(self.openOrders[symbol]):
+            if (order['side'] == 'BUY' and price <= order['price']) or (order['side'] == 'SELL' and price >= order['price']):
+                self.openOrders[symbol].remove(order)
+                self.fill(order, order['price'])
+
+    def fill(self, order, price):
+        '''
+        Fills an order at price and updates the position and the wallet
+        '''
+        qty, key = order['origQty'], (order['symbol'], order['positionSide'])
+        amt, entry = self.positions.get(key, [0., 0.])
+        signed = SIDE[order['side']]*qty
+        if amt == 0. or np.sign(amt) == np.sign(signed):
+            entry = (abs(amt)*entry + qty*price)/(abs(amt) + qty)
+        else:
+            self.wallet += np.sign(amt)*min(qty, abs(amt))*(price - entry)
+        amt = round(amt + signed, 8)
+        self.positions[key] = [amt, entry if amt != 0. else 0.]
+        self.wallet -= self.commRate[order['type']]*qty*price
+        order.update({'status': 'FILLED', 'avgPrice': float(price), 'executedQty': qty, 'updateTime': self.clock.t})
+
+    def balance(self):
+        '''
+        Returns the wallet balance as Client.balance does
+        '''
+        return [{'asset': self.currency, 'balance': str(self.wallet), 'withdrawAvailable': str(self.wallet)}]
+
+    def position_info(self):
+        '''
+        Returns the open positions of every symbol as Client.position_info does
+        '''
+        info = [{'symbol': symbol, 'positionSide': posSide, 'positionAmt': str(amt), 'entryPrice': str(entry)} \
+                for (symbol, posSide), (amt, entry) in self.positions.items()]
+        return info + [{'symbol': symbol, 'positionSide': 'BOTH', 'positionAmt': '0', 'entryPrice': '0'} for symbol in self.markets]
+
+def kline_ticks(row):
+    '''
+    Returns the trades (time, price) replayed within a 1m kline: open, the nearest extreme, the other extreme, close
+    '''
+    _t, _o, _h, _l, _c = row[:5]
+    first, second = (_l, _h) if _c >= _o else (_h, _l)
+    return ((_t, _o), (_t + 20*1000, first), (_t + 40*1000, second), (_t + 59999, _c))
+
+def open_positions(trades):
+    '''
+    Returns the number of open BUY and SELL positions after every entry and exit of closed positions (Replay.summary)
+    '''
+    # an exit frees its slot before an entry at the same time
+    times = np.concatenate([trades['excTime'].values, trades['clsTime'].values]).astype(np.int64)
+    steps = np.concatenate([np.ones(trades.shape[0]), -np.ones(trades.shape[0])])
+    order = np.lexsort((steps, times))
+    out = pd.DataFrame({'_t': times[order]})
+    for side in SIDE:
+        _side = np.tile(trades['side'].values == side, 2)
+        out[side] = np.cumsum(np.where(_side, steps, 0.)[order]).astype(int)
+    return out
+
+def load_history(cache, symbols, startTime=None, interval='1m'):
+    '''
+    Returns the cached klines of the symbols (KlineCache) as the history of a Replay
+    '''
+    return {symbol: pd.DataFrame(cache.load(symbol, interval, startTime=startTime)) for symbol in symbols}
+
+class Replay:
+    """ replay of the kline history of several symbols through the live signal and order logic """
+    def __init__(self, history, warmup=180, trades=None, pdEstimate=15, modelParams=None, initBalance=1000., \
+                 longPct=0.25, shortPct=0.25, orderPct=0.05, fileout=None):
+        '''
+        Replay class
+
+            history : dict of symbol -> 1m kline pd.DataFrame, the first warmup klines seed the models, see load_history
+
+            longPct, shortPct, orderPct : Portfolio.equity_distribution of the initial balance, whose caps on the
+                                          number of BUY and SELL positions apply across all symbols as in wss_run
+
+            trades : dict of symbol -> pd.DataFrame of 'time' and 'price' replacing the trades derived from the klines
+        '''
+        self.history = dict(history)
+        self.symbols = list(self.history)
+        self.warmup = warmup
+        self.trades = trades or {}
+        self.fileout = fileout
+        self.initBalance = initBalance
+        start = min(int(df['_t'].iloc[warmup]) for df in self.history.values())
+        self.clock = SimClock(start)
+        self.markets = {symbol: SimMarketData(symbol, self.clock) for symbol in self.symbols}
+        self.client = SimClient(self.clock, self.markets, initBalance=initBalance)
+        self.portfolio = Portfolio(self.client, tradeIns=self.symbols)
+        self.portfolio.equity_distribution(longPct=longPct, shortPct=shortPct, orderPct=orderPct)
+        self.models = {}
+        for symbol, df in self.history.items():
+            self.models[symbol] = TradingModel(symbol=symbol, testnet=True, modelType='bollinger', marketData=self.markets[symbol], \
+                                               pdObserve=df.shape[0]-warmup, pdEstimate=pdEstimate, inputData=df.iloc[:warmup], \
+                                               orderSize=self.portfolio.orderSize, **(modelParams or {}))
+        self.Signals = {symbol: [] for symbol in self.symbols}
+        self.finished = {symbol: [] for symbol in self.symbols}
+        self.nEvent = 0
+
+    def events(self, i):
+        '''
+        Returns the time-ordered (time, kind, symbol index, data) events of a symbol
+        '''
+        symbol = self.symbols[i]
+        # rows are read lazily from the kline columns, the merge holds one pending event per symbol
+        df = self.history[symbol]
+        rows = zip(*(np.asarray(df[f])[self.warmup:] for f in KLINE_FEATS))
+        if symbol in self.trades:
+            klines = ((int(row[0]) + 60*1000, KLINE, i, row) for row in rows)
+            _trades = self.trades[symbol]
+            ticks = ((int(_t), TRADE, i, float(_p)) for _t, _p in zip(_trades['time'], _trades['price']))
+            return heapq.merge(klines, ticks)
+        return ( event for row in rows for event in \
+                 [(int(_t), TRADE, i, float(_p)) for _t, _p in kline_ticks(row)] + [(int(row[0]) + 60*1000, KLINE, i, row)] )
+
+    def run(self):
+        '''
+        Replays the events of all symbols in time order, returns the signals of every symbol
+        '''
+        for _t, kind, i, data in heapq.merge(*[self.events(i) for i in range(len(self.symbols))]):
+            symbol, model = self.symbols[i], self.models[self.symbols[i]]
+            self.clock.t = _t
+            if kind == KLINE:
+                model.klines.append(data)
+                new_signal(symbol, model, self.Signals, self.symbols, self.portfolio, self.fileout)
+            else:
+                self.markets[symbol].add_trade(_t, data)
+                self.client.match(symbol, data)
+                manage_signals(symbol, model, self.client, self.Signals, self.fileout, self.symbols, self.portfolio)
+            self.archive(symbol)
+            self.nEvent += 1
+        return {symbol: self.finished[symbol] + self.Signals[symbol] for symbol in self.symbols}
+
+    def archive(self, symbol):
+        '''
+        Moves the closed and expired signals of a symbol out of the live list, which the signal logic scans per event
+        '''
+        signals = self.Signals[symbol]
+        if any(sig.is_closed() or sig.is_expired() for sig in signals):
+            self.finished[symbol] += [sig for sig in signals if sig.is_closed() or sig.is_expired()]
+            signals[:] = [sig for sig in signals if not (sig.is_closed() or sig.is_expired())]
+
+    def equity(self):
+        '''
+        Returns the portfolio balance (_t, _b) after every closed position of all symbols
+        '''
+        trades = self.summary().sort_values('clsTime')
+        return pd.DataFrame({'_t': np.asarray(trades['clsTime'], dtype=np.int64), \
+                             '_b': self.initBalance + trades['profit'].cumsum().values})
+
+    def summary(self):
+        '''
+        Returns the closed positions as a pd.DataFrame with their profit net of commissions
+        '''
+        rows = []
+        for symbol in self.symbols:
+            for sig in self.finished[symbol] + self.Signals[symbol]:
+                if sig.is_closed():
+                    comm = sig.get_quantity()*(self.client.commRate[sig.orderType]*sig.excPrice + self.client.commRate[sig.cntType]*sig.clsPrice)
+                    rows.append({ 'symbol': symbol, 'side': sig.side, 'quantity': sig.get_quantity(), 'excTime': sig.excTime, \
+                                  'excPrice': sig.excPrice, 'clsTime': sig.clsTime, 'clsPrice': sig.clsPrice, 'exitSign': sig.exitSign, \
+                                  'profit': SIDE[sig.side]*sig.get_quantity()*(sig.clsPrice - sig.excPrice) - comm })
+        return pd.DataFrame(rows, columns=['symbol', 'side', 'quantity', 'excTime', 'excPrice', 'clsTime', 'clsPrice', 'exitSign', 'profit'])
+
+if __name__ == '__main__':
+    import os, sys
+    from tradingpy import csv_to_df
+    datadir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'Week 1', 'Problems_w1', 'data', 'klines')
+    symbols = sys.argv[1:] or ['BTCUSDT', 'ETHUSDT', 'BCHUSDT', 'BNBUSDT']
+    history = {symbol: csv_to_df(os.path.join(datadir, '-%s-1m.csv' % symbol)) for symbol in symbols}
+    start_time = time.time()
+    replay = Replay(history)
+    replay.run()
+    elapsed = time.time() - start_time
+    trades = replay.summary()
+    span = max(df['_t'].iloc[-1] - df['_t'].iloc[replay.warmup] for df in history.values())/1000
+    print(trades.groupby(['symbol', 'exitSign'])['profit'].agg(['count', 'sum']))
+    opened = open_positions(trades)
+    print('\nposition caps %s, most open positions %s' % (replay.portfolio.equityDist, {side: int(opened[side].max()) for side in SIDE}))
+    print('%d events in %.1f s (%.0fx real time), final balance %.4f' % (replay.nEvent, elapsed, span/elapsed, replay.client.wallet))
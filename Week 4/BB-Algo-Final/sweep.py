@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel parameter sweep of the replay engine
+
+    python sweep.py [workers]
+
+The klines of all symbols are copied once into one shared memory block, every worker process of the pool
+attaches to it once, and only the parameters of a case and its results cross process boundaries
+"""
+import itertools, os, sys, time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+
+from klines import KLINE_FEATS, kline_dtype
+from replay import Replay
+
+# shared klines of the worker process: shared memory block and symbol -> pd.DataFrame
+_SHARED = {}
+
+def param_grid(**values):
+    '''
+    Returns the list of all combinations of the parameter values, e.g. param_grid(pdEstimate=[10, 15], numsd=[2., 2.5])
+    '''
+    names = list(values)
+    return [dict(zip(names, combo)) for combo in itertools.product(*values.values())]
+
+def share_klines(history):
+    '''
+    Returns a shared memory block holding the klines of all symbols and the layout symbol -> (start, stop) rows
+    '''
+    dtype = kline_dtype()
+    layout, start = {}, 0
+    for symbol, df in history.items():
+        layout[symbol] = (start, start + df.shape[0])
+        start += df.shape[0]
+    shm = shared_memory.SharedMemory(create=True, size=max(1, start*dtype.itemsize))
+    data = np.ndarray((start,), dtype=dtype, buffer=shm.buf)
+    for symbol, (a, b) in layout.items():
+        for f in KLINE_FEATS:
+            data[f][a:b] = np.asarray(history[symbol][f])
+    return shm, layout
+
+def attach_klines(name, layout):
+    '''
+    Pool initializer: attaches the worker to the shared klines
+    '''
+    shm = shared_memory.SharedMemory(name=name)
+    data = np.ndarray((max(b for _, b in layout.values()),), dtype=kline_dtype(), buffer=shm.buf)
+    _SHARED['shm'] = shm
+    _SHARED['history'] = {symbol: pd.DataFrame({f: data[f][a:b] for f in KLINE_FEATS}, copy=False) \
+                          for symbol, (a, b) in layout.items()}
+
+def replay_case(params, warmup=180, replayParams=None):
+    '''
+    Returns the replay of the shared klines with one parameter combination, after its run
+
+        params : pdEstimate, numsd, atrAlpha and timeLimit (seconds), missing ones keep the model defaults
+    '''
+    modelParams = {k: params[k] for k in ('numsd', 'atrAlpha') if k in params}
+    if 'timeLimit' in params:
+        modelParams['signalTimeLimit'] = params['timeLimit']
+    replay = Replay(_SHARED['history'], warmup=warmup, pdEstimate=params.get('pdEstimate', 15), \
+                    modelParams=modelParams, **(replayParams or {}))
+    replay.run()
+    return replay
+
+def trade_metrics(trades):
+    '''
+    Returns the number of trades, win rate, profit and max drawdown of closed positions (Replay.summary)
+    '''
+    equity = trades.sort_values('clsTime')['profit'].cumsum().values
+    drawdown = np.max(np.maximum.accumulate(np.append(0., equity))[1:] - equity) if equity.shape[0] > 0 else 0.
+    return { 'trades': trades.shape[0],
+             'winRate': float((trades['profit'] > 0).mean()) if trades.shape[0] > 0 else np.nan,
+             'profit': float(trades['profit'].sum()),
+             'maxDrawdown': float(drawdown) }
+
+def run_case(params, warmup=180, replayParams=None):
+    '''
+    Returns the parameters and the summary metrics of one replay of the shared klines
+    '''
+    start_time = time.time()
+    replay = replay_case(params, warmup=warmup, replayParams=replayParams)
+    return { **params, **trade_metrics(replay.summary()), 'balance': replay.client.wallet, 'seconds': time.time() - start_time }
+
+def case_trades(params, warmup=180, replayParams=None):
+    '''
+    Returns the closed positions of one replay of the shared klines
+    '''
+    return replay_case(params, warmup=warmup, replayParams=replayParams).summary()
+
+def pool_map(func, history, grid, warmup=180, workers=None, chunksize=1, replayParams=None):
+    '''
+    Returns func(params, warmup, replayParams) of every parameter combination of grid, run over a process pool
+
+        history : dict of symbol -> 1m kline pd.DataFrame, shared with the workers without pickling
+
+        workers : number of processes, all cores if None
+    '''
+    shm, layout = share_klines(history)
+    try:
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=attach_klines, \
+                                 initargs=(shm.name, layout)) as pool:
+            return list(pool.map(func, grid, itertools.repeat(warmup), itertools.repeat(replayParams), chunksize=chunksize))
+    finally:
+        shm.close()
+        shm.unlink()
+
+def sweep(history, grid, warmup=180, workers=None, chunksize=1, replayParams=None):
+    '''
+    Returns one row of summary metrics per parameter combination of grid, replayed over a process pool
+    '''
+    return pd.DataFrame(pool_map(run_case, history, grid, warmup=warmup, workers=workers, chunksize=chunksize, \
+                                 replayParams=replayParams))
+
+if __name__ == '__main__':
+    from tradingpy import csv_to_df
+    datadir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'Week 1', 'Problems_w1', 'data', 'klines')
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    history = {symbol: csv_to_df(os.path.join(datadir, '-%s-1m.csv' % symbol)) for symbol in ['BTCUSDT', 'ETHUSDT', 'BCHUSDT', 'BNBUSDT']}
+    grid = param_grid(pdEstimate=[10, 15, 20, 30], numsd=[2., 2.5, 3.], atrAlpha=[0.1, 0.3, 0.5], timeLimit=[5*60, 15*60, 30*60])
+    start_time = time.time()
+    results = sweep(history, grid, workers=workers)
+    print(results.sort_values('profit', ascending=False).head(10).to_string(index=False))
+    print('\n%d combinations in %.1f s' % (len(grid), time.time() - start_time))
@@ -9,8 +9,12 @@ import numpy as np
 import pandas as pd
 
 from tqdm import tqdm
-from binancepy import MarketData
-from indicators import Bbands, average_true_range
+from concurrent.futures import ThreadPoolExecutor
+from binancepy import MarketData, WeightBudget
+from indicators import StreamBbands, StreamATR, average_true_range, IndicatorCache, Bbands, band_cross, \
+                       expanding_atr, atr_ranges
+from features import FeaturePipeline
+from klines import KlineBuffer, KLINE_FEATS, parse_klines
 from utility import timestr, print_
 ###TRADING RULES
 QUANTPRE = {  'BTCUSDT': 3, 'ETHUSDT': 3, 'BCHUSDT': 2, 'XRPUSDT': 1, 'EOSUSDT': 1, 'LTCUSDT': 3, \
@@ -100,9 +104,30 @@ class TradingModel:
                   features: dict = None,
                   inputData = None,
                   orderSize = 1.0, #USDT
-                  breath: float = 0.01/100):
+                  breath: float = 0.01/100,
+                  atrEstimator: str = 'stream',
+                  indicatorCache: IndicatorCache = None,
+                  capacity: int = 1000,
+                  numsd: float = 2.5,
+                  atrAlpha: float = 0.3,
+                  signalTimeLimit: int = None):
         '''
         Trading Model class
+
+            features : dict of name -> (indicator, params) for a FeaturePipeline updated with every kline, see featureValues
+
+            atrEstimator : 'stream' to update the ATR barrier per kline over the whole session, 'batch' to recompute it
+                           on the klines of self.klines, i.e. the last capacity klines once the session outgrows
+                           the ring buffer (the two estimators then differ)
+
+            indicatorCache : IndicatorCache shared with other readers of the same klines, used by the 'batch' estimator
+                             and generate_signals
+
+            capacity : number of klines kept in the ring buffer self.klines, shared with the websocket threads
+
+            numsd, atrAlpha : width of the Bollinger bands and ATR quantile of the barriers
+
+            signalTimeLimit : time limit (seconds) of the signals, pdEstimate minutes if None
         '''
         self.symbol = symbol
         self.testnet = testnet
@@ -110,11 +135,30 @@ class TradingModel:
         self.marketData = marketData
         self.pdObserve = pdObserve
         self.pdEstimate = pdEstimate
-        self.inputData = inputData
+        self.klines = KlineBuffer(capacity)
+        if inputData is not None:
+            self.klines.extend(inputData)
         self.timeLimit = int(self.pdObserve*10)
         self.orderSize = orderSize
         self.breath = breath
         self.signalLock = []
+        self.atrEstimator = atrEstimator
+        self.indicatorCache = indicatorCache
+        self.bbands, self.atr = None, None
+        self.lastCount = 0
+        self.numsd = numsd
+        self.atrAlpha = atrAlpha
+        self.signalTimeLimit = pdEstimate*60 if signalTimeLimit is None else signalTimeLimit
+        self.features = features
+        self.featurePipe = FeaturePipeline(features) if features else None
+        self.featureValues = {}
+
+    @property
+    def inputData(self):
+        '''
+        Returns a copy of the stored klines as a pd.DataFrame
+        '''
+        return self.klines.to_df()
 
     def add_signal_lock(self, slock=None):
         '''
@@ -130,54 +174,175 @@ class TradingModel:
         if (slock is not None) and (slock in self.signalLock):
             self.signalLock.remove(slock)
 
-    def build_initial_input(self, period=180):
+    def build_initial_input(self, period=180, t_server=None, budget=None, workers=1, cache=None):
         '''
         Download and store historical data
+
+            t_server : server time shared by all models, requested here if None
+
+            budget : WeightBudget shared by all models, workers : number of concurrent page requests
+
+            cache : KlineCache to read the history from, only the missing tail is downloaded and saved
         '''
         if self.modelType=='bollinger':
             min_in_candle = 1
             num_klns = period
-            t_server = self.marketData.server_time()['serverTime']
+            if t_server is None:
+                t_server = self.marketData.server_time()['serverTime']
             t_start = t_server - num_klns*min_in_candle*60*1000
-            df = klns_to_df(self.marketData.candles_data(interval='1m', startTime=t_start, limit=num_klns), ['_t', '_o', '_h', '_l', '_c', '_v'])
-            if self.inputData is None:
-                self.inputData = df
-            else:
-                df = df[df['_t'] > self.inputData['_t'].iloc[-1]]
-                self.inputData = self.inputData.append(df, ignore_index=True)
+            if num_klns >= self.klines.capacity:
+                _klines = KlineBuffer(num_klns + 1)
+                _klines.extend(self.klines.view())
+                self.klines = _klines
+            t_fetch = t_start
+            if cache is not None:
+                cached = cache.load(self.symbol, '1m', startTime=t_start)
+                # use the cache only if it covers the start of the period, and only up to its first gap
+                gaps = np.nonzero(np.diff(cached['_t']) > min_in_candle*60*1000)[0]
+                if gaps.shape[0] > 0:
+                    cached = {f: v[:gaps[0]+1] for f, v in cached.items()}
+                if cached['_t'].shape[0] > 0 and cached['_t'][0] < t_start + min_in_candle*60*1000:
+                    self.klines.extend(cached)
+                    t_fetch = int(cached['_t'][-1]) + min_in_candle*60*1000
+            if t_fetch <= t_server:
+                klns = self.marketData.candles_history(interval='1m', startTime=t_fetch, endTime=t_server, budget=budget, workers=workers)
+                klns = parse_klines(klns, KLINE_FEATS)
+                if cache is not None:
+                    closed = klns['_t'] + min_in_candle*60*1000 <= t_server
+                    cache.save(self.symbol, '1m', {f: v[closed] for f, v in klns.items()})
+                self.klines.extend(klns)
+            self.bbands, self.atr = None, None
         return self.inputData
 
     def get_last_signal(self, dataObserve=None):
         '''
         Process the lastest data for a potential singal
+
+            dataObserve : pd.DataFrame of klines to add to self.klines first, None if they are already there
         '''
         if self.modelType=='bollinger':
-            _data = dataObserve[dataObserve['_t'] > self.inputData['_t'].iloc[-1]]
-            _data = self.inputData.append(_data, ignore_index=True)
-            
-            _, bb_up, bb_down = Bbands(_data['_c'], window=self.pdEstimate, numsd=2.5)
-            # up cross
-            crit1 = _data['_c'].shift(1) < bb_up.shift(1)
-            crit2 = _data['_c'] > bb_up
-            up_cross = _data[crit1 & crit2]
-            # down cross
-            crit1 = _data['_c'].shift(1) > bb_down.shift(1)
-            crit2 = _data['_c'] < bb_down
-            dn_cross = _data[crit1 & crit2]
-
-            _data['side'] = np.zeros(_data.shape[0])
-            _data.loc[up_cross.index, 'side'] = -1.
-            _data.loc[dn_cross.index, 'side'] = 1.
-            _side = _data['side'].iloc[-1]
-
-            atr, _ = average_true_range(_data.copy(), period=self.pdEstimate, alpha=0.3, highlow=False)
-  
-            if _side == 1. and not 'BUY' in self.signalLock:
-                return {'side': 'BUY', 'positionSide': 'LONG', '_t': _data['_t'].iloc[-1], '_p': _data['_c'].iloc[-1], 'atr' : atr}
-            elif _side == -1. and not 'SELL' in self.signalLock:
-                return {'side': 'SELL', 'positionSide': 'SHORT', '_t': _data['_t'].iloc[-1], '_p': _data['_c'].iloc[-1], 'atr' : atr}
+            if self.bbands is None:
+                # the websocket thread appends to self.klines concurrently: n is read once and the
+                # streams are seeded and advanced on exactly the first n klines
+                with self.klines.lock:
+                    total = self.klines.n
+                    _data = self.klines.to_df(total=total)
+                self.bbands = StreamBbands(window=self.pdEstimate, numsd=self.numsd)
+                self.bbands.build_history(_data['_c'])
+                if self.atrEstimator == 'stream':
+                    self.atr = StreamATR(period=self.pdEstimate, alpha=self.atrAlpha, highlow=False)
+                    self.atr.build_history(_data)
+                if self.featurePipe is not None:
+                    self.featureValues = self.featurePipe.build_history(_data)
+                self.lastCount = total
+            if dataObserve is not None:
+                self.klines.extend(dataObserve)
+            # only the klines added since the last call are read, whatever the session length
+            with self.klines.lock:
+                total = self.klines.n
+                _new = self.klines.view(total - self.lastCount, total=total).copy()
+                _t = self.klines.last_time(total)
+            self.lastCount = total
+            for _h, _l, _c, _v in zip(_new['_h'], _new['_l'], _new['_c'], _new['_v']):
+                self.bbands.do_next(_c)
+                if self.atrEstimator == 'stream':
+                    self.atr.do_next(_h, _l, _c)
+                if self.featurePipe is not None:
+                    self.featureValues = self.featurePipe.do_next(_h, _l, _c, _v)
+            (c0, _, up0, dn0), (c1, _, up1, dn1) = self.bbands.get_bands()
+            _side = self.bollinger_side(np.array([c0, c1]), np.array([up0, up1]), np.array([dn0, dn1]))[-1]
+            _p = c1
+
+            if self.atrEstimator == 'stream':
+                atr, _ = self.atr.get_value()
+            else:
+                # the klines are copied into a frame only when the cache misses
+                atr, _ = self.indicator(average_true_range, lambda: self.klines.to_df(total=total), \
+                                        times=self.klines.view(total=total)['_t'], \
+                                        period=self.pdEstimate, alpha=self.atrAlpha, highlow=False)
+
+            return self.signal_dict(_side, _t, _p, atr)
         return None
 
+    def indicator(self, func, df, times=None, **params):
+        '''
+        Returns func(df, **params), through self.indicatorCache if there is one
+
+            df : kline frame, or a function returning it (called only when the result is not cached)
+        '''
+        if self.indicatorCache is None:
+            return func(df() if callable(df) else df, **params)
+        return self.indicatorCache.compute(func, df, symbol=self.symbol, times=times, **params)
+
+    def bollinger_side(self, close, upband, dnband):
+        '''
+        Returns the side of every bar: 1. for BUY on a cross below the lower band, -1. for SELL on a cross above
+        the upper band, 0. otherwise or when the side is locked (shared by get_last_signal and generate_signals)
+        '''
+        side = np.zeros(close.shape[0])
+        side[1:] = band_cross(close[:-1], close[1:], upband[:-1], upband[1:], dnband[:-1], dnband[1:])
+        if 'BUY' in self.signalLock:
+            side[side == 1.] = 0.
+        if 'SELL' in self.signalLock:
+            side[side == -1.] = 0.
+        return side
+
+    def signal_dict(self, side, _t, _p, atr):
+        '''
+        Returns the signal of a bar side, None if there is none
+        '''
+        if side == 1.:
+            return {'side': 'BUY', 'positionSide': 'LONG', '_t': _t, '_p': _p, 'atr' : atr}
+        elif side == -1.:
+            return {'side': 'SELL', 'positionSide': 'SHORT', '_t': _t, '_p': _p, 'atr' : atr}
+        return None
+
+    def generate_signals(self, history):
+        '''
+        Returns the signals of every bar of a kline history in one pass, as a pd.DataFrame of side, positionSide,
+        _t, _p and atr indexed by bar (the signal get_last_signal returns when the model has seen history up to that bar)
+        '''
+        if self.modelType!='bollinger':
+            return pd.DataFrame(columns=['side', 'positionSide', '_t', '_p', 'atr'])
+        close = np.asarray(history['_c'], dtype=float)
+        # models and sweeps replaying the same history share the bands and ATR through self.indicatorCache
+        _, upband, dnband = self.indicator(Bbands, pd.Series(close), times=history['_t'], window=self.pdEstimate, numsd=self.numsd)
+        side = self.bollinger_side(close, upband.values, dnband.values)
+        idx = np.nonzero(side)[0]
+        if self.atrEstimator == 'stream':
+            atr = self.indicator(expanding_atr, history, period=self.pdEstimate, alpha=self.atrAlpha, highlow=False)[0][idx]
+        else:
+            # the batch estimator reads the last capacity klines kept by the ring buffer, as get_last_signal
+            _rng = self.indicator(atr_ranges, history, period=self.pdEstimate, highlow=False)
+            atr = np.full(idx.shape[0], np.nan)
+            for j, i in enumerate(idx):
+                _r = _rng[max(i - self.klines.capacity + 1 + self.pdEstimate, 0):i+1]
+                _r = _r[~np.isnan(_r)]
+                if _r.shape[0] > 0:
+                    atr[j] = np.quantile(_r, self.atrAlpha)
+        signals = pd.DataFrame({ 'side': np.where(side[idx] == 1., 'BUY', 'SELL'),
+                                 'positionSide': np.where(side[idx] == 1., 'LONG', 'SHORT'),
+                                 '_t': np.asarray(history['_t'], dtype=np.int64)[idx],
+                                 '_p': close[idx],
+                                 'atr': atr }, index=idx)
+        return signals
+
+def build_initial_inputs(models, period=180, workers=8, budget=None, cache=None):
+    '''
+    Download the historical data of all models concurrently, with one server time sample and one weight budget
+
+        cache : KlineCache shared by all models
+    '''
+    models = list(models)
+    if len(models) == 0:
+        return models
+    t_server = models[0].marketData.server_time()['serverTime']
+    budget = WeightBudget() if budget is None else budget
+    inner = max(1, workers//len(models))
+    with ThreadPoolExecutor(min(workers, len(models))) as pool:
+        list(pool.map(lambda m: m.build_initial_input(period=period, t_server=t_server, budget=budget, workers=inner, cache=cache), models))
+    return models
+
 #%%%%
 
 class Signal:
@@ -398,11 +563,22 @@ class Signal:
 
 ###%%%
 
-def klns_to_df(market_data, feats):
+def klns_to_df(market_data, feats, dtype=np.float64):
     '''
     Return a pd.DataFrame from candles data received from the exchange
+
+        dtype : np.float32 for compact prices and volumes (see indicators.band_cross_precision), _t is int64
     '''
     fts = list(str(f) for f in feats)
-    df_ = pd.DataFrame(market_data, columns = ['_t', '_o', '_h', '_l', '_c', '_v', 'close_time', 'quote_av', 'trades', 'tb_base_av', 'tb_quote_av', 'ignore'])
-    df_[['_o', '_h', '_l', '_c', '_v']] = df_[['_o', '_h', '_l', '_c', '_v']].astype(float)
-    return df_[fts]
+    return pd.DataFrame(parse_klines(market_data, fts, dtype=dtype), columns=fts)
+
+def csv_to_df(filepath, feats=None, dtype=np.float64):
+    '''
+    Return a pd.DataFrame from a klines csv file, e.g. Week 1/Problems_w1/data/klines/-BTCUSDT-1m.csv
+
+        dtype : np.float32 for compact prices and volumes, _t is int64
+    '''
+    df_ = pd.read_csv(filepath, index_col=0, dtype={'_t': np.int64, '_o': dtype, '_h': dtype, '_l': dtype, '_c': dtype, '_v': dtype})
+    if feats is None:
+        return df_
+    return df_[list(str(f) for f in feats)]
@@ -20,8 +20,10 @@ def barstr(text, symbol='#', length=100, space_size=5):
   
 def print_(s, file):
     '''
-    Prints a string s into file
+    Prints a string s into file (nothing is printed when file is None, e.g. in a replay)
     '''
+    if file is None:
+        return
     with open(file, "a+") as f: 
         f.write('\n' + str(s)) 
     f.close()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Walk-forward optimization of the model parameters on the replay engine
+
+    python walkforward.py [train] [test] [workers]
+
+Train and test windows (in 1m klines) slide over the history: the parameter combination with the best
+in-sample metric of a train window is traded on the following test window, and the out-of-sample trades
+of all folds are stitched into one equity curve. Every combination is replayed once over the whole history,
+these replays running in parallel in the sweep process pool, and the folds then read their windows from
+those trades one after the other (a cheap filter), so the indicators and positions shared by overlapping
+windows are computed once instead of once per fold
+
+A position counts in a window only if it is opened and closed within it: no in-sample score reads a profit
+realized in the test window, and the stitched curve never holds two positions of one symbol taken from the
+runs of two folds as long as step >= test (positions still open at the end of a test window are left out)
+
+The replay engine is used rather than the Backtester of Week 1/Problems_w1, which cannot be imported next
+to these modules (it lives in another tradingpy module) and replays the notebook's hand-written order
+lifecycle rather than the live one
+"""
+import os, sys, time
+import numpy as np
+import pandas as pd
+
+from sweep import param_grid, pool_map, case_trades, trade_metrics
+
+def fold_windows(start, stop, train, test, step=None):
+    '''
+    Returns the (train start, test start, test stop) times (ms) of the folds between start and stop
+
+        train, test, step : lengths in 1m klines, step is test if None
+    '''
+    train, test, step = train*60*1000, test*60*1000, (step or test)*60*1000
+    return [(a, a + train, min(a + train + test, stop)) for a in range(int(start), int(stop) - train, step)]
+
+def walk_forward(history, grid, train=7*24*60, test=24*60, step=None, warmup=180, metric='profit', workers=None, \
+                 initBalance=1000., replayParams=None):
+    '''
+    Returns the folds (windows, chosen parameters, in-sample and out-of-sample metrics) and the stitched
+    out-of-sample equity curve (_t, _b) as pd.DataFrames
+
+    A train window where no combination scores (metric NaN for all, e.g. winRate without closed trades)
+    keeps the parameters of the previous fold with refit False, and is skipped before the first fit
+
+        history : dict of symbol -> 1m kline pd.DataFrame
+
+        grid : list of parameter combinations, see sweep.param_grid
+
+        metric : column of sweep.trade_metrics maximized in-sample
+    '''
+    replayParams = {**(replayParams or {}), 'initBalance': initBalance}
+    trades = pool_map(case_trades, history, grid, warmup=warmup, workers=workers, replayParams=replayParams)
+    start = min(int(df['_t'].iloc[warmup]) for df in history.values())
+    stop = max(int(df['_t'].iloc[-1]) for df in history.values()) + 60*1000
+    folds, oos, best = [], [], None
+    for trainStart, testStart, testStop in fold_windows(start, stop, train, test, step):
+        # a position belongs to a window if it is opened and closed within it
+        inSample = [trade_metrics(t[(t['excTime'] >= trainStart) & (t['clsTime'] < testStart)]) for t in trades]
+        scores = np.array([m[metric] for m in inSample], dtype=float)
+        refit = not np.isnan(scores).all()
+        if refit:
+            best = int(np.nanargmax(scores))
+        elif best is None:
+            # no combination has a score (e.g. winRate without closed trades) and none was fitted yet
+            continue
+        t = trades[best]
+        t = t[(t['excTime'] >= testStart) & (t['clsTime'] < testStop)]
+        oos.append(t)
+        folds.append({ 'trainStart': trainStart, 'testStart': testStart, 'testStop': testStop, 'refit': refit, **grid[best], \
+                       **{'is_' + k: v for k, v in inSample[best].items()}, \
+                       **{'oos_' + k: v for k, v in trade_metrics(t).items()} })
+    oos = pd.concat(oos, ignore_index=True).sort_values('clsTime') if len(oos) > 0 else pd.DataFrame(columns=['clsTime', 'profit'])
+    equity = pd.DataFrame({'_t': np.asarray(oos['clsTime'], dtype=np.int64), '_b': initBalance + oos['profit'].cumsum().values})
+    return pd.DataFrame(folds), equity
+
+if __name__ == '__main__':
+    from tradingpy import csv_to_df
+    datadir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'Week 1', 'Problems_w1', 'data', 'klines')
+    args = [int(a) for a in sys.argv[1:]]
+    train = args[0] if len(args) > 0 else 12*60
+    test = args[1] if len(args) > 1 else 4*60
+    workers = args[2] if len(args) > 2 else None
+    history = {symbol: csv_to_df(os.path.join(datadir, '-%s-1m.csv' % symbol)) for symbol in ['BTCUSDT', 'ETHUSDT', 'BCHUSDT']}
+    grid = param_grid(pdEstimate=[10, 15, 20, 30], numsd=[2., 2.5, 3.], atrAlpha=[0.1, 0.3, 0.5], timeLimit=[5*60, 15*60, 30*60])
+    start_time = time.time()
+    folds, equity = walk_forward(history, grid, train=train, test=test, workers=workers)
+    print(folds.to_string(index=False))
+    print('\n%d folds x %d combinations in %.1f s, out-of-sample balance %.4f' % \
+          (folds.shape[0], len(grid), time.time() - start_time, equity['_b'].iloc[-1] if equity.shape[0] > 0 else np.nan))
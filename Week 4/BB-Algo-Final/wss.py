@@ -7,14 +7,159 @@ Created on Sat Mar 24 00:16:07 2020
 
 import time, sys, math
 import numpy as np
-import pandas as pd
 import websocket
 import threading
 import json
 
 from tradingpy import PRICEPRE, SIDE, Signal
+from klines import parse_kline
 from utility import print_, orderstr, timestr, barstr
 
+def position_count(insIds, signal_list, side='BOTH'):
+    '''
+    Returns number of open positions
+    '''
+    count = 0
+    for s in insIds:
+        for sig in signal_list[s]:
+            if sig.side==side or side=='BOTH':
+                if sig.is_ordered() or sig.is_active() or sig.is_cnt_ordered():
+                    count += 1
+    return count
+
+def in_possition_(signal_list, side='BOTH'):
+    '''
+    Check if there is any open positions
+    '''
+    in_pos = False
+    for sig in signal_list:
+        if sig.side==side or side=='BOTH':
+            if sig.is_ordered() or sig.is_active() or sig.is_cnt_ordered():
+                in_pos = True
+                break
+    return in_pos
+
+def get_possible_price(mk_data, side):
+    '''
+    Return a safe limit price available on the market
+    '''
+    mk_depth = mk_data.order_book(limit=5)
+    bids = list(float(x[0]) for x in mk_depth['bids'])
+    asks = list(float(x[0]) for x in mk_depth['asks'])
+    try:
+        lim = (side=='BUY')*(bids[0]+bids[1])/2 + (side=='SELL')*(asks[0]+asks[1])/2
+        lim = round(lim, PRICEPRE[mk_data.symbol.upper()])
+    except:
+        lim = None
+    return bids, asks, lim
+
+def new_signal(symbol, model, Signals, insIds, portfolio, fileout):
+    '''
+    Books the signal of the last kline of a model as WAITING (shared by wss_run and the replay engine)
+    '''
+    if model.modelType == 'bollinger':
+        model_sig = model.get_last_signal()
+    else: model_sig = None
+    if model_sig is not None:
+        ready = True
+        if ready:
+            side, positionSide, startTime = model_sig['side'], model_sig['positionSide'], model_sig['_t']+60*1000
+            expTime, price = startTime + 5*60*1000, round(model_sig['_p'], PRICEPRE[symbol]) #
+            stopLoss = model_sig['atr']
+            takeProfit = model_sig['atr']
+            new_sig = Signal(symbol=symbol, side=side, size=model.orderSize, orderType='LIMIT', positionSide=positionSide, price=price, startTime=startTime, expTime=expTime, \
+                         stopLoss=stopLoss, takeProfit=takeProfit, timeLimit=model.signalTimeLimit, timeInForce='GTC')
+            if in_possition_(Signals[symbol], side='BOTH') or position_count(insIds, Signals, side=side) >= portfolio.equityDist[side]:
+                new_sig.set_expired()
+            else:
+                for sig in Signals[symbol]:
+                    if sig.is_waiting():
+                        sig.set_expired()
+                        print_('\n\tSet WAITING signal EXPIRED: \n\t' + str(sig), fileout)
+            Signals[symbol].append(new_sig)
+            print_('\n\tFOUND ' + str(new_sig), fileout)
+    return model_sig
+
+def manage_signals(symbol, model, client, Signals, fileout, insIds=None, portfolio=None):
+    '''
+    Excecutes/cancels/tracks the signals of a symbol (shared by wss_run and the replay engine)
+
+        insIds, portfolio : if given, a NEW order is placed only while portfolio.equityDist caps the open positions of its side
+    '''
+    in_position = False
+    last_signal = None
+    for sig in Signals[symbol]:
+        sv_time = client.timestamp()
+        if sig.is_waiting():
+            ### Check for EXPIRED order here ###
+            if sv_time > sig.expTime:
+                sig.set_expired()
+                print_('\n\tSet WAITING signal EXPIRED: \n\t' + str(sig), fileout)
+            else:
+                last_signal = sig
+
+        elif sig.is_ordered():
+            ### Set ACTIVE order here ###
+            in_position = True
+            order_update = client.query_order(symbol, sig.orderId)
+            if order_update['status'] == 'FILLED':
+                sig.set_active(excTime=order_update['updateTime'], excPrice=order_update['avgPrice'], excQty=order_update['executedQty'])                 
+                sig.path_update(lastTime=sig.excTime, lastPrice=sig.excPrice) 
+                print_('\n\tSet BOOKED order ACTIVE: \n\t' + str(sig) + '\n\t' + orderstr(order_update), fileout)
+
+            ### PROBLEM 3 Insert your code to handle EXPIRED and PARTIALLY_FILLED order here ###
+            elif sv_time > order_update['updateTime'] + 60*1000:
+                if order_update['status'] == 'PARTIALLY_FILLED':
+                    client.cancel_order(symbol, sig.orderId)
+                    sig.set_active(excTime=order_update['updateTime'], excPrice=order_update['avgPrice'], excQty=order_update['executedQty'])
+                    sig.path_update(lastTime=sig.excTime, lastPrice=sig.excPrice)
+                    print_('\n\tSet BOOKED order ACTIVE: \n\t' + str(sig) + '\n\t' + orderstr(order_update), fileout)
+                elif sv_time > order_update['updateTime'] + 2*60*1000:
+                    client.cancel_order(symbol, sig.orderId)
+                    sig.set_expired()
+                    order_update = client.query_order(symbol, sig.orderId)
+                    print_('\n\tSet BOOKED order EXPIRED: \n\t' + str(sig) + '\n\t' + orderstr(order_update), fileout)
+
+        elif sig.is_active():
+            ### Control ACTIVE position here ###
+            in_position = True
+            recent_trades = model.marketData.recent_trades(limit=5)
+            for trade in recent_trades:
+                if int(trade['time']) > sig.pricePath[-1]['timestamp']:
+                    sig.path_update(lastTime=trade['time'], lastPrice=trade['price'])
+            exit_sign, pos = sig.exit_triggers()
+            if exit_sign:
+                print_('\n\tFound ' + str(exit_sign) + '{}\n'.format(round(pos,4)), fileout)
+                cnt_order = sig.counter_order()
+                order = client.new_order(symbol=symbol, side=cnt_order['side'], orderType='MARKET', quantity=cnt_order['amt'], positionSide=sig.positionSide) #, timeInForce=cnt_order['TIF'], price=lim)
+                sig.set_cnt_ordered(cntorderId=order['orderId'], cntType='MARKET', cntTime=order['updateTime'])
+                print_('\tPlaced COUNTER order: \n\t' + str(sig) + '\n\t' + orderstr(order), fileout)
+
+        elif sig.is_cnt_ordered():
+            ### Set CLOSED position here ###
+            in_position = True
+            order_update = client.query_order(symbol, sig.cntorderId)
+            if order_update['status'] == 'FILLED':
+                sig.set_closed(clsTime=order_update['updateTime'], clsPrice=order_update['avgPrice'])
+                print_('\n\tClosed order: \n\t' + str(sig) + '\n\t' + orderstr(order_update), fileout)
+
+    if (not in_position) and (last_signal is not None):
+        ### Check for ENTRY and place NEW order here ###
+        sig = last_signal
+        if portfolio is not None and position_count(insIds, Signals, side=sig.side) >= portfolio.equityDist[sig.side]:
+            # signals of several symbols booked on the same kline all passed the cap in new_signal
+            return
+        if sig.orderType == 'MARKET':
+            order  = client.new_order(symbol=symbol, side=sig.side, orderType=sig.orderType, quantity=sig.get_quantity(), positionSide=sig.positionSide)
+            sig.set_ordered(orderId=order['orderId'], orderTime=order['updateTime'], limitPrice=None)
+            print_('\n\tPlaced NEW order: \n\t' + str(sig) + '\n\t' + orderstr(order), fileout)
+        elif sig.orderType=='LIMIT':
+            bids, asks, lim = get_possible_price(model.marketData, sig.side)
+            if lim is not None and (lim < sig.price*1.01 and lim > sig.price*0.99):
+                order = client.new_order(symbol=symbol, side=sig.side, orderType=sig.orderType, quantity=sig.get_quantity(), positionSide=sig.positionSide, timeInForce='GTC', price=lim)
+                sig.set_ordered(orderId=order['orderId'], orderTime=order['updateTime'], limitPrice=lim)
+                print_('\n\tPlaced NEW order: \n\t' + str(sig) + '\n\t' + orderstr(order), fileout)
+
 def wss_run(*args):
     ### threading functions
     def data_stream(*args):
@@ -26,9 +171,9 @@ def wss_run(*args):
         ws.send(json.dumps({"method": "SUBSCRIBE", "params": params, "id": 1 }))
         t1_idx = 0
         while len(endFlag)==0:
-            if len(SymKlns[insIds[0]]) % 5 == 0 and len(SymKlns[insIds[0]]) > t1_idx and len(SymKlns[insIds[0]]) < models[insIds[0]].pdObserve:
+            if n_streamed(insIds[0]) % 5 == 0 and n_streamed(insIds[0]) > t1_idx and n_streamed(insIds[0]) < models[insIds[0]].pdObserve:
                 client.keepalive_stream()
-                t1_idx = len(SymKlns[insIds[0]])
+                t1_idx = n_streamed(insIds[0])
             
     def strategy(*args):
         '''
@@ -37,34 +182,13 @@ def wss_run(*args):
         t2_idx = {}
         for symbol in insIds:
             t2_idx[symbol] = 0
-        while len(endFlag)==0 and len(SymKlns[insIds[0]]) < models[insIds[0]].pdObserve:
+        while len(endFlag)==0 and n_streamed(insIds[0]) < models[insIds[0]].pdObserve:
             try:
                 for symbol in insIds:
-                    sym_ = SymKlns[symbol].copy()
-                    if len(sym_) > t2_idx[symbol]:
-                        if models[symbol].modelType == 'bollinger':
-                            data_ob = pd.DataFrame(sym_)
-                            model_sig = models[symbol].get_last_signal(dataObserve=data_ob) 
-                        else: model_sig = None
-                        if model_sig is not None:
-                            ready = True
-                            if ready:
-                                side, positionSide, startTime = model_sig['side'], model_sig['positionSide'], model_sig['_t']+60*1000
-                                expTime, price = startTime + 5*60*1000, round(model_sig['_p'], PRICEPRE[symbol]) #
-                                stopLoss = model_sig['atr']
-                                takeProfit = model_sig['atr']
-                                new_sig = Signal(symbol=symbol, side=side, size=models[symbol].orderSize, orderType='LIMIT', positionSide=positionSide, price=price, startTime=startTime, expTime=expTime, \
-                                             stopLoss=stopLoss, takeProfit=takeProfit, timeLimit=models[symbol].pdEstimate*60, timeInForce='GTC')
-                                if in_possition_(Signals[symbol], side='BOTH') or position_count(insIds, Signals, side=side) >= portfolio.equityDist[side]:
-                                    new_sig.set_expired()
-                                else:
-                                    for sig in Signals[symbol]:
-                                        if sig.is_waiting():
-                                            sig.set_expired()
-                                            print_('\n\tSet WAITING signal EXPIRED: \n\t' + str(sig), fileout)
-                                Signals[symbol].append(new_sig)
-                                print_('\n\tFOUND ' + str(new_sig), fileout)
-                        t2_idx[symbol] = len(sym_)
+                    n_ = n_streamed(symbol)
+                    if n_ > t2_idx[symbol]:
+                        new_signal(symbol, models[symbol], Signals, insIds, portfolio, fileout)
+                        t2_idx[symbol] = n_
             except Exception:
                 print_('\n\tClose on strategy()', fileout)
                 ws.close()
@@ -73,81 +197,11 @@ def wss_run(*args):
         '''
         Third thread to excecute/cancel/track the signals generated in strategy()
         '''
-        while len(endFlag)==0 and len(SymKlns[insIds[0]]) < models[insIds[0]].pdObserve:
+        while len(endFlag)==0 and n_streamed(insIds[0]) < models[insIds[0]].pdObserve:
             try:
                 time.sleep(1)
                 for symbol in insIds:
-                    in_position = False
-                    last_signal = None
-                    for sig in Signals[symbol]:
-                        model = models[symbol]
-                        sv_time = client.timestamp()
-                        if sig.is_waiting():
-                            ### Check for EXPIRED order here ###
-                            if sv_time > sig.expTime:
-                                sig.set_expired()
-                                print_('\n\tSet WAITING signal EXPIRED: \n\t' + str(sig), fileout)
-                            else:
-                                last_signal = sig
-
-                        elif sig.is_ordered():
-                            ### Set ACTIVE order here ###
-                            in_position = True
-                            order_update = client.query_order(symbol, sig.orderId)
-                            if order_update['status'] == 'FILLED':
-                                sig.set_active(excTime=order_update['updateTime'], excPrice=order_update['avgPrice'], excQty=order_update['executedQty'])                 
-                                sig.path_update(lastTime=sig.excTime, lastPrice=sig.excPrice) 
-                                print_('\n\tSet BOOKED order ACTIVE: \n\t' + str(sig) + '\n\t' + orderstr(order_update), fileout)
-
-                            ### PROBLEM 3 Insert your code to handle EXPIRED and PARTIALLY_FILLED order here ###
-                            elif sv_time > order_update['updateTime'] + 60*1000:
-                                if order_update['status'] == 'PARTIALLY_FILLED':
-                                    client.cancel_order(symbol, sig.orderId)
-                                    sig.set_active(excTime=order_update['updateTime'], excPrice=order_update['avgPrice'], excQty=order_update['executedQty'])
-                                    sig.path_update(lastTime=sig.excTime, lastPrice=sig.excPrice)
-                                    print_('\n\tSet BOOKED order ACTIVE: \n\t' + str(sig) + '\n\t' + orderstr(order_update), fileout)
-                                elif sv_time > order_update['updateTime'] + 2*60*1000:
-                                    client.cancel_order(symbol, sig.orderId)
-                                    sig.set_expired()
-                                    order_update = client.query_order(symbol, sig.orderId)
-                                    print_('\n\tSet BOOKED order EXPIRED: \n\t' + str(sig) + '\n\t' + orderstr(order_update), fileout)
-
-                        elif sig.is_active():
-                            ### Control ACTIVE position here ###
-                            in_position = True
-                            recent_trades = model.marketData.recent_trades(limit=5)
-                            for trade in recent_trades:
-                                if int(trade['time']) > sig.pricePath[-1]['timestamp']:
-                                    sig.path_update(lastTime=trade['time'], lastPrice=trade['price'])
-                            exit_sign, pos = sig.exit_triggers()
-                            if exit_sign:
-                                print_('\n\tFound ' + str(exit_sign) + '{}\n'.format(round(pos,4)), fileout)
-                                cnt_order = sig.counter_order()
-                                order = client.new_order(symbol=symbol, side=cnt_order['side'], orderType='MARKET', quantity=cnt_order['amt'], positionSide=sig.positionSide) #, timeInForce=cnt_order['TIF'], price=lim)
-                                sig.set_cnt_ordered(cntorderId=order['orderId'], cntType='MARKET', cntTime=order['updateTime'])
-                                print_('\tPlaced COUNTER order: \n\t' + str(sig) + '\n\t' + orderstr(order), fileout)
-
-                        elif sig.is_cnt_ordered():
-                            ### Set CLOSED position here ###
-                            in_position = True
-                            order_update = client.query_order(symbol, sig.cntorderId)
-                            if order_update['status'] == 'FILLED':
-                                sig.set_closed(clsTime=order_update['updateTime'], clsPrice=order_update['avgPrice'])
-                                print_('\n\tClosed order: \n\t' + str(sig) + '\n\t' + orderstr(order_update), fileout)
-
-                    if (not in_position) and (last_signal is not None):
-                        ### Check for ENTRY and place NEW order here ###
-                        sig = last_signal
-                        if sig.orderType == 'MARKET':
-                            order  = client.new_order(symbol=symbol, side=sig.side, orderType=sig.orderType, quantity=sig.get_quantity(), positionSide=sig.positionSide)
-                            sig.set_ordered(orderId=order['orderId'], orderTime=order['updateTime'], limitPrice=None)
-                            print_('\n\tPlaced NEW order: \n\t' + str(sig) + '\n\t' + orderstr(order), fileout)
-                        elif sig.orderType=='LIMIT':
-                            bids, asks, lim = get_possible_price(model.marketData, sig.side)
-                            if lim is not None and (lim < sig.price*1.01 and lim > sig.price*0.99):
-                                order = client.new_order(symbol=symbol, side=sig.side, orderType=sig.orderType, quantity=sig.get_quantity(), positionSide=sig.positionSide, timeInForce='GTC', price=lim)
-                                sig.set_ordered(orderId=order['orderId'], orderTime=order['updateTime'], limitPrice=lim)
-                                print_('\n\tPlaced NEW order: \n\t' + str(sig) + '\n\t' + orderstr(order), fileout)
+                    manage_signals(symbol, models[symbol], client, Signals, fileout, insIds, portfolio)
             except Exception:
                 print_('\n\tClose on book_manager()', fileout)
                 ws.close()
@@ -163,9 +217,9 @@ def wss_run(*args):
             kln = mess['k']
             if kln['x'] is True:
                 symbol = kln['s'].upper()
-                new_kln = { '_t': int(kln['t']), '_o': float(kln['o']), '_h': float(kln['h']), '_l': float(kln['l']), '_c': float(kln['c']), '_v': float(kln['q']) }
+                new_kln = parse_kline(kln)
                 SymKlns[symbol].append(new_kln)
-                print_( '%d. %s\t' % (len(SymKlns[symbol]), symbol) + timestr(new_kln['_t']) + '\t' + \
+                print_( '%d. %s\t' % (n_streamed(symbol), symbol) + timestr(new_kln['_t']) + '\t' + \
                         ''.join(['{:>3}:{:<10}'.format(k, v) for k,v in iter(new_kln.items()) if not k=='_t']), fileout)
 
     def on_error(ws, error):
@@ -192,51 +246,22 @@ def wss_run(*args):
         t3.start()
         return
 
-    def position_count(insIds, signal_list, side='BOTH'):
-        '''
-        Returns number of open positions
-        '''
-        count = 0
-        for s in insIds:
-            for sig in signal_list[s]:
-                if sig.side==side or side=='BOTH':
-                    if sig.is_ordered() or sig.is_active() or sig.is_cnt_ordered():
-                        count += 1
-        return count
-
-    def in_possition_(signal_list, side='BOTH'):
-        '''
-        Check if there is any open positions
-        '''
-        in_pos = False
-        for sig in signal_list:
-            if sig.side==side or side=='BOTH':
-                if sig.is_ordered() or sig.is_active() or sig.is_cnt_ordered():
-                    in_pos = True
-                    break
-        return in_pos
-
-    def get_possible_price(mk_data, side):
+    def n_streamed(symbol):
         '''
-        Return a safe limit price available on the market
+        Returns number of klines received from the stream
         '''
-        mk_depth = mk_data.order_book(limit=5)
-        bids = list(float(x[0]) for x in mk_depth['bids'])
-        asks = list(float(x[0]) for x in mk_depth['asks'])
-        try:
-            lim = (side=='BUY')*(bids[0]+bids[1])/2 + (side=='SELL')*(asks[0]+asks[1])/2
-            lim = round(lim, PRICEPRE[mk_data.symbol.upper()])
-        except:
-            lim = None
-        return bids, asks, lim
+        return SymKlns[symbol].n - nStart[symbol]
 
     start_time = time.time()
     portfolio, client, testnet, stream, models, fileout = args
     insIds = portfolio.tradeIns
     SymKlns = {}
+    nStart = {}
     Signals = {}
     for symbol in insIds:
-       SymKlns[symbol] = []
+       # closed klines go straight into the model ring buffer read by get_last_signal
+       SymKlns[symbol] = models[symbol].klines
+       nStart[symbol] = SymKlns[symbol].n
        Signals[symbol] = []
        
     endFlag = []